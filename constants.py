@@ -4,7 +4,9 @@ import os
 from chromadb.config import Settings
 
 # https://python.langchain.com/en/latest/modules/indexes/document_loaders/examples/excel.html?highlight=xlsx#microsoft-excel
-from langchain.document_loaders import CSVLoader, PDFMinerLoader, TextLoader, UnstructuredExcelLoader, Docx2txtLoader
+from langchain.document_loaders import CSVLoader, TextLoader, UnstructuredExcelLoader, Docx2txtLoader
+
+from pdfium_loader import PyPDFium2Loader
 
 # load_dotenv()
 ROOT_DIRECTORY = os.path.dirname(os.path.realpath(__file__))
@@ -14,8 +16,42 @@ SOURCE_DIRECTORY = f"{ROOT_DIRECTORY}/SOURCE_DOCUMENTS"
 
 PERSIST_DIRECTORY = f"{ROOT_DIRECTORY}/DB"
 
+# Content hashes of the ingested files, used to only re-ingest files that changed
+INGEST_MANIFEST = f"{PERSIST_DIRECTORY}/manifest.json"
+
 MODELS_PATH = "./models"
 
+# Written by convert_to_onnx.py and used by `ingest.py --onnx`
+ONNX_EMBEDDING_MODEL_PATH = f"{ROOT_DIRECTORY}/models/instructor-onnx"
+# Written by `convert_to_onnx.py --quantize`, run_localGPT.py embeds queries with it when they run on the CPU
+ONNX_QUANTIZED_MODEL_FILE = "model_quantized.onnx"
+# int8 query embeddings whose cosine similarity with the stored fp16/fp32 embeddings of the same text is lower
+# than this are reported at startup, see `embedding_utils.check_embedding_parity`
+EMBEDDING_MIN_SIMILARITY = 0.98
+
+# Devices accepted by the --device_type option of the scripts
+DEVICE_TYPES = [
+    "cpu",
+    "cuda",
+    "ipu",
+    "xpu",
+    "mkldnn",
+    "opengl",
+    "opencl",
+    "ideep",
+    "hip",
+    "ve",
+    "fpga",
+    "ort",
+    "xla",
+    "lazy",
+    "vulkan",
+    "mps",
+    "meta",
+    "hpu",
+    "mtia",
+]
+
 # Can be changed to a specific number
 INGEST_THREADS = os.cpu_count() or 8
 
@@ -25,9 +61,46 @@ CHROMA_SETTINGS = Settings(
     is_persistent=True,
 )
 
+# HNSW index parameters for new Chroma collections. They are stored with the collection when it is
+# created by ingest.py; Chroma's defaults (M=16, construction_ef=100, search_ef=10) give poor recall.
+CHROMA_COLLECTION_METADATA = {
+    "hnsw:M": 32,
+    "hnsw:construction_ef": 200,
+    "hnsw:search_ef": 64,
+}
+
+# Quantized matmul kernels for GPTQ models, selected with --kernel. exllamav2 works on any recent NVIDIA GPU,
+# marlin needs compute capability 8.0 (Ampere) or newer.
+GPTQ_KERNELS = ["exllama", "exllamav2", "marlin", "triton"]
+GPTQ_KERNEL = "exllamav2"
+
+# Engines that can run full (non-quantized) HuggingFace models, selected with --engine. "trtllm" runs a
+# TensorRT-LLM engine built into TRTLLM_ENGINE_DIRECTORY as described in the README.
+ENGINES = ["hf", "trtllm"]
+
+# torch.compile modes, selected with --compile. "dynamic" compiles the forward pass for prompts of any length
+# (and the query encoder), "static" compiles it for a static KV cache and captures it in CUDA graphs.
+COMPILE_MODES = ["none", "dynamic", "static"]
+TRTLLM_ENGINE_DIRECTORY = f"{MODELS_PATH}/trtllm_engine"
+# GPTQ models are spread over all GPUs up to this share of their memory (the rest is left for the KV cache and
+# activations), layers that do not fit are offloaded to at most CPU_OFFLOAD_MEMORY of RAM
+GPU_MEMORY_FRACTION = 0.85
+CPU_OFFLOAD_MEMORY = "32GiB"
+
+# Vectorstores that can answer queries, selected with --vectorstore. "faiss" builds a FAISS index from the Chroma
+# collection the first time it is used (and again after every ingest) and saves it next to the Chroma database.
+# "mmap" does the same with a plain matrix of normalized embeddings that is memory-mapped instead of loaded.
+VECTORSTORES = ["chroma", "faiss", "mmap"]
+FAISS_INDEX_DIRECTORY = f"{PERSIST_DIRECTORY}/faiss"
+MMAP_INDEX_DIRECTORY = f"{PERSIST_DIRECTORY}/mmap"
+# Collections with at least this many chunks use an approximate HNSW index instead of exact search
+FAISS_HNSW_THRESHOLD = 1_000_000
+
 # Context Window and Max New Tokens
 CONTEXT_WINDOW_SIZE = 4096
-MAX_NEW_TOKENS = CONTEXT_WINDOW_SIZE  # int(CONTEXT_WINDOW_SIZE/4)
+MAX_NEW_TOKENS = 512  # Only counts the generated answer, the prompt is not included
+# Number of previous question/answer pairs kept in the chat history, so the prompt stays bounded however long the chat
+HISTORY_WINDOW_SIZE = 4
 
 #### If you get a "not enough space in the buffer" error, you should reduce the values below, start with half of the original values and keep halving the value until the error stops appearing
 
@@ -46,7 +119,7 @@ DOCUMENT_MAP = {
     ".txt": TextLoader,
     ".md": TextLoader,
     ".py": TextLoader,
-    ".pdf": PDFMinerLoader,
+    ".pdf": PyPDFium2Loader,
     ".csv": CSVLoader,
     ".xls": UnstructuredExcelLoader,
     ".xlsx": UnstructuredExcelLoader,
@@ -54,6 +127,11 @@ DOCUMENT_MAP = {
     ".doc": Docx2txtLoader,
 }
 
+# Plain-text loaders are IO-bound and are run on threads. Every other loader (pdf, excel, docx) spends
+# most of its time in a CPU-bound parser and is run in worker processes instead. PDFium releases the GIL,
+# but it is not thread-safe, so PDFs stay in the worker processes as well.
+IO_BOUND_EXTENSIONS = {".txt", ".md", ".py", ".csv"}
+
 # Default Instructor Model
 EMBEDDING_MODEL_NAME = "hkunlp/instructor-large" # Uses 1.5 GB of VRAM (High Accuracy with lower VRAM usage)
 
@@ -0,0 +1,134 @@
+"""
+Export the Instructor embedding model to ONNX Runtime.
+Run this once before `python ingest.py --onnx`. Instructor models are T5 models of which only the encoder is
+used, so only the encoder is exported, and the weights of the dense head that follows the pooling layer are
+saved next to it as dense.npz. With --quantize an int8 copy of the encoder is saved as well, which
+run_localGPT.py uses to embed the queries on the CPU. Every exported model is checked against INSTRUCTOR.encode.
+"""
+
+import logging
+import os
+import platform
+
+import click
+import numpy as np
+import torch
+from InstructorEmbedding import INSTRUCTOR
+from optimum.onnxruntime import ORTQuantizer
+from optimum.onnxruntime.configuration import AutoQuantizationConfig
+from sentence_transformers.models import Dense
+from torch import nn
+from transformers import AutoTokenizer
+
+from constants import EMBEDDING_MODEL_NAME, ONNX_EMBEDDING_MODEL_PATH, ONNX_QUANTIZED_MODEL_FILE
+from embedding_utils import DEFAULT_EMBED_INSTRUCTION, OnnxInstructorEmbeddings
+
+# Minimum cosine similarity between the ONNX and the PyTorch embeddings of the parity check texts
+MIN_SIMILARITY = 0.999
+MIN_SIMILARITY_INT8 = 0.95
+PARITY_TEXTS = [
+    "The first amendment protects the freedom of speech, religion, the press, assembly and petition.",
+    "def add(a, b):\n    return a + b",
+    "Systems engineering is an interdisciplinary approach to the design and management of complex systems.",
+    "short",
+]
+
+
+class EncoderOutput(nn.Module):
+    # The T5 encoder returns a model output, the ONNX graph only has the last hidden state as its output
+    def __init__(self, encoder):
+        super().__init__()
+        self.encoder = encoder
+
+    def forward(self, input_ids, attention_mask):
+        return self.encoder(input_ids=input_ids, attention_mask=attention_mask, return_dict=True).last_hidden_state
+
+
+def export_encoder(instructor, tokenizer):
+    transformer = instructor[0].auto_model
+    # T5EncoderModel or T5Model, the decoder of the latter is not used by Instructor
+    encoder = getattr(transformer, "encoder", transformer)
+    sample = tokenizer(PARITY_TEXTS[:2], padding=True, return_tensors="pt")
+    torch.onnx.export(
+        EncoderOutput(encoder).eval(),
+        (sample["input_ids"], sample["attention_mask"]),
+        os.path.join(ONNX_EMBEDDING_MODEL_PATH, "model.onnx"),
+        input_names=["input_ids", "attention_mask"],
+        output_names=["last_hidden_state"],
+        dynamic_axes={
+            "input_ids": {0: "batch_size", 1: "sequence_length"},
+            "attention_mask": {0: "batch_size", 1: "sequence_length"},
+            "last_hidden_state": {0: "batch_size", 1: "sequence_length"},
+        },
+        opset_version=14,
+    )
+    transformer.config.save_pretrained(ONNX_EMBEDDING_MODEL_PATH)
+
+
+def check_parity(instructor, file_name, min_similarity):
+    """
+    Compare the embeddings of the exported model with INSTRUCTOR.encode on the CPU.
+    Raises a ValueError if the cosine similarity of any of the PARITY_TEXTS is below `min_similarity`.
+    """
+    expected = instructor.encode(
+        [[DEFAULT_EMBED_INSTRUCTION, text] for text in PARITY_TEXTS], normalize_embeddings=True
+    )
+    embeddings = OnnxInstructorEmbeddings(device_type="cpu", file_name=file_name)
+    actual = np.asarray(embeddings.embed_documents(PARITY_TEXTS))
+    similarity = float((expected * actual).sum(axis=1).min())
+    if similarity < min_similarity:
+        raise ValueError(f"{file_name} does not match {EMBEDDING_MODEL_NAME}, cosine similarity {similarity:.4f}")
+    logging.info(f"{file_name} matches {EMBEDDING_MODEL_NAME}, cosine similarity {similarity:.4f}")
+
+
+def quantize():
+    # Dynamic quantization only needs the weights, the activation ranges are computed at runtime
+    if platform.machine().lower() in ["arm64", "aarch64"]:
+        quantization_config = AutoQuantizationConfig.arm64(is_static=False, per_channel=False)
+    else:
+        quantization_config = AutoQuantizationConfig.avx2(is_static=False, per_channel=False)
+    quantizer = ORTQuantizer.from_pretrained(ONNX_EMBEDDING_MODEL_PATH, file_name="model.onnx")
+    quantizer.quantize(save_dir=ONNX_EMBEDDING_MODEL_PATH, quantization_config=quantization_config)
+    logging.info(f"Saved the int8 encoder as {ONNX_QUANTIZED_MODEL_FILE}")
+
+
+@click.command()
+@click.option(
+    "--quantize",
+    "quantize_int8",
+    is_flag=True,
+    help="Also save an int8 copy of the encoder for CPU query embedding (Default is False)",
+)
+def main(quantize_int8):
+    logging.info(f"Exporting {EMBEDDING_MODEL_NAME} to {ONNX_EMBEDDING_MODEL_PATH}")
+    os.makedirs(ONNX_EMBEDDING_MODEL_PATH, exist_ok=True)
+    instructor = INSTRUCTOR(EMBEDDING_MODEL_NAME, device="cpu")
+    tokenizer = AutoTokenizer.from_pretrained(EMBEDDING_MODEL_NAME, use_fast=True)
+    tokenizer.save_pretrained(ONNX_EMBEDDING_MODEL_PATH)
+    export_encoder(instructor, tokenizer)
+
+    # The pooling and normalization layers have no weights, only the dense layers need to be kept
+    dense = {}
+    for module in instructor:
+        if isinstance(module, Dense):
+            if not isinstance(module.activation_function, nn.Identity):
+                raise ValueError("Only dense layers without an activation function can be exported")
+            i = len(dense) // 2
+            dense[f"weight_{i}"] = module.linear.weight.detach().numpy()
+            bias = module.linear.bias
+            dense[f"bias_{i}"] = (
+                bias.detach().numpy() if bias is not None else np.zeros(module.linear.out_features, np.float32)
+            )
+    np.savez(os.path.join(ONNX_EMBEDDING_MODEL_PATH, "dense.npz"), **dense)
+    check_parity(instructor, "model.onnx", MIN_SIMILARITY)
+    if quantize_int8:
+        quantize()
+        check_parity(instructor, ONNX_QUANTIZED_MODEL_FILE, MIN_SIMILARITY_INT8)
+    logging.info("ONNX export finished")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(filename)s:%(lineno)s - %(message)s", level=logging.INFO
+    )
+    main()
@@ -0,0 +1,348 @@
+"""
+This file implements the embedding wrappers used for ingestion and retrieval.
+"""
+
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import torch
+from langchain.embeddings import HuggingFaceEmbeddings, HuggingFaceInstructEmbeddings
+from langchain.embeddings.base import Embeddings
+from tqdm import trange
+from transformers import AutoTokenizer
+
+from constants import (
+    EMBEDDING_MIN_SIMILARITY,
+    EMBEDDING_MODEL_NAME,
+    ONNX_EMBEDDING_MODEL_PATH,
+    ONNX_QUANTIZED_MODEL_FILE,
+)
+
+DEFAULT_EMBED_INSTRUCTION = "Represent the document for retrieval: "
+DEFAULT_QUERY_INSTRUCTION = "Represent the question for retrieving supporting documents: "
+
+
+class OnnxInstructorEmbeddings(Embeddings):
+    """
+    Instructor embeddings computed with ONNX Runtime instead of PyTorch.
+    The encoder is exported by convert_to_onnx.py. The pooling and dense head of the Instructor model are
+    small enough to run in numpy on the encoder output, so only the transformer runs in ONNX Runtime.
+    Parameters:
+    - model_path (str): Directory written by convert_to_onnx.py.
+    - device_type (str): "cuda" runs the session on the CUDAExecutionProvider, anything else on the CPU.
+    - batch_size (int): Number of texts encoded per forward pass.
+    - max_seq_length (int): On CUDA every batch is padded to this length so the session only sees one input
+      shape. On the CPU batches are only padded to their longest text.
+    - file_name (str): The ONNX file in `model_path`, e.g. the int8 copy written by `convert_to_onnx.py --quantize`.
+    """
+
+    def __init__(
+        self,
+        model_path=ONNX_EMBEDDING_MODEL_PATH,
+        device_type="cuda",
+        batch_size=32,
+        max_seq_length=512,
+        embed_instruction=DEFAULT_EMBED_INSTRUCTION,
+        query_instruction=DEFAULT_QUERY_INSTRUCTION,
+        file_name="model.onnx",
+    ):
+        import onnxruntime as ort
+
+        self.embed_instruction = embed_instruction
+        self.query_instruction = query_instruction
+        self.batch_size = batch_size
+        self.max_seq_length = max_seq_length
+        self.device = "cuda" if device_type == "cuda" else "cpu"
+
+        providers = ["CUDAExecutionProvider"] if self.device == "cuda" else ["CPUExecutionProvider"]
+        self.session = ort.InferenceSession(os.path.join(model_path, file_name), providers=providers)
+        self.tokenizer = AutoTokenizer.from_pretrained(model_path, use_fast=True)
+
+        dense = np.load(os.path.join(model_path, "dense.npz"))
+        self.dense_layers = [(dense[f"weight_{i}"], dense[f"bias_{i}"]) for i in range(len(dense.files) // 2)]
+
+    def _instruction_length(self, instruction):
+        # Instructor excludes the instruction tokens (but not the trailing EOS) from mean pooling
+        length = len(self.tokenizer(instruction)["input_ids"]) - 1
+        return length if length > 1 else 0
+
+    def _encode(self, instruction, texts):
+        import onnxruntime as ort
+
+        instruction_length = self._instruction_length(instruction)
+        vectors = []
+        for i in range(0, len(texts), self.batch_size):
+            batch = [instruction + text.strip() for text in texts[i : i + self.batch_size]]
+            encoded = self.tokenizer(
+                batch,
+                padding="max_length" if self.device == "cuda" else True,
+                truncation=True,
+                max_length=self.max_seq_length,
+                return_tensors="np",
+            )
+            input_ids = encoded["input_ids"].astype(np.int64)
+            attention_mask = encoded["attention_mask"].astype(np.int64)
+
+            # Bind the inputs on the session device so ONNX Runtime does not copy them on every run
+            binding = self.session.io_binding()
+            binding.bind_ortvalue_input("input_ids", ort.OrtValue.ortvalue_from_numpy(input_ids, self.device, 0))
+            binding.bind_ortvalue_input(
+                "attention_mask", ort.OrtValue.ortvalue_from_numpy(attention_mask, self.device, 0)
+            )
+            binding.bind_output("last_hidden_state", self.device)
+            self.session.run_with_iobinding(binding)
+            token_embeddings = binding.copy_outputs_to_cpu()[0]
+
+            pooling_mask = attention_mask.astype(np.float32)
+            pooling_mask[:, :instruction_length] = 0
+            pooled = (token_embeddings * pooling_mask[..., None]).sum(axis=1)
+            pooled /= np.clip(pooling_mask.sum(axis=1, keepdims=True), 1e-9, None)
+            for weight, bias in self.dense_layers:
+                pooled = pooled @ weight.T + bias
+            vectors.append(pooled / np.linalg.norm(pooled, axis=1, keepdims=True))
+
+        return np.concatenate(vectors) if vectors else np.empty((0, 0), dtype=np.float32)
+
+    def embed_documents(self, texts):
+        return self._encode(self.embed_instruction, texts).tolist()
+
+    def embed_query(self, text):
+        return self._encode(self.query_instruction, [text])[0].tolist()
+
+
+def encode_pinned(client, inputs, batch_size=128, show_progress=False):
+    """
+    Encode many texts with a sentence-transformers model in large batches.
+    All inputs are tokenized once up front, sorted by length so each batch is only padded to its longest
+    text, and fed to the model as token ids from pinned memory, which lets the host to device copies overlap
+    with compute on CUDA. The forward passes run under inference mode.
+    Parameters:
+    - client (SentenceTransformer): The model, e.g. `embeddings.client`.
+    - inputs (list): The texts, or [instruction, text] pairs for Instructor models.
+    - batch_size (int): Number of texts per forward pass.
+    - show_progress (bool): Show a progress bar over the batches.
+    Returns:
+    - numpy.ndarray: One L2-normalized float32 embedding per input, in the same order as `inputs`.
+    """
+    device = client._target_device
+    client.to(device)
+    client.eval()
+
+    # The fast tokenizer handles all inputs in one call, padded to the longest one
+    features = client.tokenize(inputs)
+    lengths = features["attention_mask"].sum(dim=1)
+    order = torch.argsort(lengths, descending=True)
+    # int32 halves the host memory and the transfer size, the ids are widened again on the device
+    features = {name: value[order].to(torch.int32) for name, value in features.items()}
+    if device.type == "cuda":
+        features = {name: value.pin_memory() for name, value in features.items()}
+    lengths = lengths[order]
+
+    vectors = []
+    with torch.inference_mode():
+        for start in trange(0, len(inputs), batch_size, desc="Batches", disable=not show_progress):
+            end = start + batch_size
+            width = int(lengths[start])
+            batch = {}
+            for name, value in features.items():
+                # Rows are sliced on the host to keep the pinned copy contiguous, padding is trimmed on the device
+                value = value[start:end].to(device, non_blocking=True).long()
+                batch[name] = value[:, :width] if value.dim() == 2 else value
+            output = client.forward(batch)["sentence_embedding"]
+            vectors.append(torch.nn.functional.normalize(output.float(), p=2, dim=1).cpu())
+
+    embeddings_sorted = torch.cat(vectors)
+    result = torch.empty_like(embeddings_sorted)
+    result[order] = embeddings_sorted
+    return result.numpy()
+
+
+class PinnedInstructEmbeddings(HuggingFaceInstructEmbeddings):
+    """HuggingFaceInstructEmbeddings that embeds documents with `encode_pinned`."""
+
+    def encode_documents(self, texts, show_progress=False):
+        instruction_pairs = [[self.embed_instruction, text] for text in texts]
+        return encode_pinned(self.client, instruction_pairs, self.encode_kwargs["batch_size"], show_progress)
+
+    def embed_documents(self, texts):
+        return self.encode_documents(texts).tolist()
+
+
+class PinnedHuggingFaceEmbeddings(HuggingFaceEmbeddings):
+    """HuggingFaceEmbeddings that embeds documents with `encode_pinned`."""
+
+    def encode_documents(self, texts, show_progress=False):
+        texts = [text.replace("\n", " ") for text in texts]
+        return encode_pinned(self.client, texts, self.encode_kwargs["batch_size"], show_progress)
+
+    def embed_documents(self, texts):
+        return self.encode_documents(texts).tolist()
+
+
+def quantize_for_cpu(embeddings):
+    """
+    Quantize the linear layers of a sentence-transformers embedding model to int8 for CPU inference.
+    The weights are stored as int8 and the matmuls run through the int8 GEMM kernels, which roughly
+    halves the memory traffic of the encoder. This is only worth it on the CPU.
+    """
+    torch.set_num_threads(os.cpu_count() or 1)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # Can only be set before any inter-op parallel work has started
+        pass
+    torch.quantization.quantize_dynamic(embeddings.client, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    return embeddings
+
+
+def load_embeddings(device_type, model_name=EMBEDDING_MODEL_NAME, compile_encoder=False, quantize=True):
+    """
+    Load the embedding model used by ingest.py and run_localGPT.py.
+    Instructor models are loaded with HuggingFaceInstructEmbeddings, any other sentence-transformers model
+    (e.g. sentence-transformers/all-MiniLM-L6-v2 for lower query latency) with HuggingFaceEmbeddings. Both
+    embed documents with `encode_pinned`.
+    Parameters:
+    - device_type (str): The device the model runs on. The model runs in fp16 on CUDA and is quantized to
+      int8 on the CPU.
+    - model_name (str): The HuggingFace model id. ingest.py and run_localGPT.py have to use the same model.
+    - compile_encoder (bool): Compile the transformer with torch.compile on CUDA. Worth it for the many
+      small query batches, not for the single long pass over all documents in ingest.py.
+    - quantize (bool): False keeps the model in fp32 on the CPU.
+    Returns:
+    - Embeddings: The embedding model, its embeddings are L2-normalized.
+    """
+    kwargs = {
+        "model_name": model_name,
+        "model_kwargs": {"device": device_type},
+        "encode_kwargs": {"batch_size": 64, "normalize_embeddings": True},
+    }
+    if "instructor" in model_name.lower():
+        embeddings = PinnedInstructEmbeddings(**kwargs)
+    else:
+        embeddings = PinnedHuggingFaceEmbeddings(**kwargs)
+
+    if device_type == "cuda":
+        # sentence-transformers does not take a dtype when loading, so the weights are converted afterwards
+        embeddings.client.half()
+        if compile_encoder and hasattr(torch, "compile"):
+            # Compile the transformer and not the SentenceTransformer, whose encode method has to stay reachable
+            transformer = embeddings.client[0].auto_model
+            transformer.forward = torch.compile(transformer.forward, mode="default", dynamic=True)
+    elif device_type == "cpu" and quantize:
+        embeddings = quantize_for_cpu(embeddings)
+    return embeddings
+
+
+def load_query_embeddings(device_type, model_name=EMBEDDING_MODEL_NAME, compile_encoder=False, quantize=True):
+    """
+    Load the embedding model used for the queries.
+    On the CPU the int8 ONNX encoder from `convert_to_onnx.py --quantize` is used when it has been exported
+    for this model, otherwise the model is loaded with `load_embeddings`, see there for `compile_encoder`
+    and `quantize`. With quantize=False the queries are embedded in fp32 on the CPU.
+    """
+    onnx_file = os.path.join(ONNX_EMBEDDING_MODEL_PATH, ONNX_QUANTIZED_MODEL_FILE)
+    if device_type == "cpu" and quantize and model_name == EMBEDDING_MODEL_NAME and os.path.exists(onnx_file):
+        return OnnxInstructorEmbeddings(device_type="cpu", file_name=ONNX_QUANTIZED_MODEL_FILE)
+    return load_embeddings(device_type, model_name, compile_encoder=compile_encoder, quantize=quantize)
+
+
+def check_embedding_parity(collection, embeddings, sample_size=8, min_similarity=EMBEDDING_MIN_SIMILARITY):
+    """
+    Compare the embeddings of a few ingested chunks with the vectors ingest.py stored for them.
+    Queries are embedded in int8 on the CPU while the documents were usually embedded in fp16 on CUDA, so
+    this shows how far apart the two are for the actual model and documents.
+    Parameters:
+    - collection (chromadb.Collection): The Chroma collection written by ingest.py.
+    - embeddings (Embeddings): The embedding model used for the queries.
+    - sample_size (int): Number of chunks compared.
+    - min_similarity (float): A warning is logged when the cosine similarity of any chunk is lower.
+    Returns:
+    - float: The lowest cosine similarity of the sample, or None if the collection is empty.
+    """
+    sample = collection.get(limit=sample_size, include=["embeddings", "documents"])
+    if not sample["ids"]:
+        return None
+    stored = np.asarray(sample["embeddings"], dtype=np.float32)
+    computed = np.asarray(embeddings.embed_documents(sample["documents"]), dtype=np.float32)
+    stored /= np.clip(np.linalg.norm(stored, axis=1, keepdims=True), 1e-12, None)
+    computed /= np.clip(np.linalg.norm(computed, axis=1, keepdims=True), 1e-12, None)
+    similarity = float((stored * computed).sum(axis=1).min())
+    if similarity < min_similarity:
+        logging.warning(
+            f"The query embeddings only reach a cosine similarity of {similarity:.4f} with the ingested ones, "
+            "pass --embed_fp32 to embed the queries in fp32"
+        )
+    else:
+        logging.info(f"The query embeddings match the ingested ones, cosine similarity {similarity:.4f}")
+    return similarity
+
+
+class CachedQueryEmbeddings(Embeddings):
+    """
+    Wraps an embedding model and keeps the embeddings of the most recent queries.
+    Repeated questions in the interactive loop then skip the embedding forward pass entirely.
+    Parameters:
+    - embeddings (Embeddings): The embedding model to wrap. Documents are always passed through.
+    - maxsize (int): Number of query embeddings to keep, the least recently used one is evicted first.
+    """
+
+    def __init__(self, embeddings, maxsize=1024):
+        self.embeddings = embeddings
+        self.maxsize = maxsize
+        self._cache = OrderedDict()
+        # The query service embeds from worker threads
+        self._lock = threading.Lock()
+
+    def get(self, text):
+        with self._lock:
+            embedding = self._cache.get(text)
+            if embedding is not None:
+                self._cache.move_to_end(text)
+            return embedding
+
+    def put(self, text, embedding):
+        with self._lock:
+            self._cache[text] = embedding
+            self._cache.move_to_end(text)
+            if len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+
+    def embed_documents(self, texts):
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text):
+        embedding = self.get(text)
+        if embedding is None:
+            embedding = self.embeddings.embed_query(text)
+            self.put(text, embedding)
+        return embedding
+
+
+def embed_queries(embeddings, queries):
+    """
+    Embed several queries at once.
+    Cached queries are answered from the cache and the rest are encoded in a single forward pass when the
+    model supports it; other embedding models fall back to one query at a time.
+    """
+    if isinstance(embeddings, CachedQueryEmbeddings):
+        vectors = [embeddings.get(query) for query in queries]
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            computed = embed_queries(embeddings.embeddings, [queries[i] for i in missing])
+            for i, vector in zip(missing, computed):
+                embeddings.put(queries[i], vector)
+                vectors[i] = vector
+        return vectors
+    if isinstance(embeddings, HuggingFaceInstructEmbeddings):
+        instruction_pairs = [[embeddings.query_instruction, query] for query in queries]
+        encode_kwargs = {**embeddings.encode_kwargs, "batch_size": len(instruction_pairs)}
+        return embeddings.client.encode(instruction_pairs, **encode_kwargs).tolist()
+    if isinstance(embeddings, OnnxInstructorEmbeddings):
+        return embeddings._encode(embeddings.query_instruction, queries).tolist()
+    if isinstance(embeddings, HuggingFaceEmbeddings):
+        encode_kwargs = {**embeddings.encode_kwargs, "batch_size": len(queries)}
+        return embeddings.client.encode(queries, **encode_kwargs).tolist()
+    return [embeddings.embed_query(query) for query in queries]
@@ -1,22 +1,38 @@
+import hashlib
+import json
 import logging
+import multiprocessing as mp
 import os
-from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 
 import click
+import numpy as np
 import torch
+from joblib import Parallel, delayed
 from langchain.docstore.document import Document
-from langchain.embeddings import HuggingFaceInstructEmbeddings
+from langchain.embeddings.base import Embeddings
 from langchain.text_splitter import Language, RecursiveCharacterTextSplitter
 from langchain.vectorstores import Chroma
 
 from constants import (
+    CHROMA_COLLECTION_METADATA,
     CHROMA_SETTINGS,
+    DEVICE_TYPES,
     DOCUMENT_MAP,
     EMBEDDING_MODEL_NAME,
     INGEST_THREADS,
+    INGEST_MANIFEST,
+    IO_BOUND_EXTENSIONS,
     PERSIST_DIRECTORY,
     SOURCE_DIRECTORY,
 )
+from embedding_utils import (
+    OnnxInstructorEmbeddings,
+    PinnedHuggingFaceEmbeddings,
+    PinnedInstructEmbeddings,
+    load_embeddings,
+)
 
 
 def load_single_document(file_path: str) -> Document:
@@ -30,20 +46,8 @@ def load_single_document(file_path: str) -> Document:
     return loader.load()[0]
 
 
-def load_document_batch(filepaths):
-    logging.info("Loading document batch")
-    # create a thread pool
-    with ThreadPoolExecutor(len(filepaths)) as exe:
-        # load files
-        futures = [exe.submit(load_single_document, name) for name in filepaths]
-        # collect data
-        data_list = [future.result() for future in futures]
-        # return data and file paths
-        return (data_list, filepaths)
-
-
-def load_documents(source_dir: str) -> list[Document]:
-    # Loads all documents from the source documents directory, including nested folders
+def find_documents(source_dir: str) -> list[str]:
+    # Finds all supported documents in the source documents directory, including nested folders
     paths = []
     for root, _, files in os.walk(source_dir):
         for file_name in files:
@@ -51,25 +55,114 @@ def load_documents(source_dir: str) -> list[Document]:
             source_file_path = os.path.join(root, file_name)
             if file_extension in DOCUMENT_MAP.keys():
                 paths.append(source_file_path)
+    return paths
+
+
+def hash_file(file_path: str) -> str:
+    with open(file_path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+def hash_files(paths: list[str]) -> dict[str, str]:
+    # hashlib releases the GIL while hashing, so the files are hashed on threads
+    with ThreadPoolExecutor(min(32, max(len(paths), 1))) as executor:
+        return dict(zip(paths, executor.map(hash_file, paths)))
+
+
+def load_manifest() -> dict:
+    # The manifest records the embedding model the vectorstore was built with ("embeddings") and maps every
+    # ingested file to the sha256 of its contents at the time it was ingested ("files")
+    if not os.path.exists(INGEST_MANIFEST):
+        return {"embeddings": None, "files": {}}
+    with open(INGEST_MANIFEST) as f:
+        manifest = json.load(f)
+    if "files" not in manifest:
+        # Written before the embedding model was recorded, so it is unknown
+        return {"embeddings": None, "files": manifest}
+    return manifest
+
+
+def save_manifest(manifest: dict):
+    os.makedirs(os.path.dirname(INGEST_MANIFEST), exist_ok=True)
+    with open(INGEST_MANIFEST, "w") as f:
+        json.dump(manifest, f, indent=2)
+
+
+def diff_manifest(
+    manifest: dict, file_hashes: dict[str, str], source_directory: str, embedding_config: dict
+) -> tuple[list[str], list[str], bool]:
+    """
+    Compare the files found in the source directory with the manifest of the last ingest.
+    Args:
+        manifest (dict): The manifest from `load_manifest`.
+        file_hashes (dict[str, str]): The sha256 of every file found in the source directory.
+        source_directory (str): The directory the files were found in.
+        embedding_config (dict): The embedding model and backend of this ingest.
+    Returns:
+        tuple[list[str], list[str], bool]: The new or changed files, the files removed from the source
+        directory, and whether the vectorstore was embedded with another model and has to be rebuilt. When
+        it has, every file counts as new.
+    """
+    # Embeddings of another model cannot be mixed with the ingested ones, so everything is embedded again
+    rebuild = bool(manifest["files"]) and manifest["embeddings"] != embedding_config
+    ingested = {} if rebuild else manifest["files"]
+    changed = [path for path, file_hash in file_hashes.items() if ingested.get(path) != file_hash]
+    # Files outside the source directory were ingested from another directory and are kept
+    source_prefix = os.path.join(source_directory, "")
+    removed = [path for path in ingested if path.startswith(source_prefix) and path not in file_hashes]
+    return changed, removed, rebuild
+
+
+def update_manifest(
+    manifest: dict,
+    file_hashes: dict[str, str],
+    changed: list[str],
+    removed: list[str],
+    rebuild: bool,
+    embedding_config: dict,
+) -> dict:
+    # The manifest after ingesting the files from `diff_manifest`
+    files = {} if rebuild else dict(manifest["files"])
+    for path in removed:
+        del files[path]
+    files.update((path, file_hashes[path]) for path in changed)
+    return {"embeddings": embedding_config, "files": files}
+
+
+def replace_chunks(collection, paths: list[str], texts: list[Document], vectors: np.ndarray):
+    # Drop the chunks of changed and removed files before adding the new ones
+    for path in paths:
+        collection.delete(where={"source": path})
+    if texts:
+        collection.add(
+            ids=[str(uuid.uuid1()) for _ in texts],
+            embeddings=vectors.tolist(),
+            documents=[doc.page_content for doc in texts],
+            metadatas=[doc.metadata for doc in texts],
+        )
+
+
+def load_documents(paths: list[str]) -> list[Document]:
+    # Loads the documents at the given paths
+    io_paths, cpu_paths = [], []
+    for path in paths:
+        if os.path.splitext(path)[1] in IO_BOUND_EXTENSIONS:
+            io_paths.append(path)
+        else:
+            cpu_paths.append(path)
 
-    # Have at least one worker and at most INGEST_THREADS workers
-    n_workers = min(INGEST_THREADS, max(len(paths), 1))
-    chunksize = round(len(paths) / n_workers)
     docs = []
-    with ProcessPoolExecutor(n_workers) as executor:
-        futures = []
-        # split the load operations into chunks
-        for i in range(0, len(paths), chunksize):
-            # select a chunk of filenames
-            filepaths = paths[i : (i + chunksize)]
-            # submit the task
-            future = executor.submit(load_document_batch, filepaths)
-            futures.append(future)
-        # process all results
-        for future in as_completed(futures):
-            # open the file and load the data
-            contents, _ = future.result()
-            docs.extend(contents)
+    if io_paths:
+        # Text files are cheap to parse, so threads avoid the cost of pickling them back from a process
+        with ThreadPoolExecutor(min(32, len(io_paths))) as executor:
+            docs.extend(executor.map(load_single_document, io_paths))
+    if cpu_paths:
+        # Have at least one worker and at most INGEST_THREADS workers
+        n_workers = max(1, min(INGEST_THREADS, len(cpu_paths)))
+        # Small chunks keep the workers evenly loaded and stream documents back as soon as they are parsed
+        chunksize = max(1, len(cpu_paths) // (n_workers * 4))
+        with mp.Pool(n_workers) as pool:
+            docs.extend(pool.imap_unordered(load_single_document, cpu_paths, chunksize=chunksize))
 
     return docs
 
@@ -87,75 +180,119 @@ def split_documents(documents: list[Document]) -> tuple[list[Document], list[Doc
     return text_docs, python_docs
 
 
+def split_in_parallel(splitter, documents: list[Document]) -> list[Document]:
+    # Splitting is pure-Python string work that holds the GIL, so spread the documents over processes
+    if len(documents) <= 16:
+        return splitter.split_documents(documents)
+    chunks = Parallel(n_jobs=INGEST_THREADS, backend="loky", batch_size=16)(
+        delayed(splitter.split_documents)([doc]) for doc in documents
+    )
+    return [chunk for doc_chunks in chunks for chunk in doc_chunks]
+
+
+def embed_documents(embeddings: Embeddings, documents: list[Document]):
+    """
+    Pre-compute the embeddings for all chunks.
+    Chroma.from_documents embeds through embed_documents in batches of 32 and converts every embedding to a
+    list. The models from load_embeddings encode the whole corpus with `encode_pinned` instead, other
+    embedding models (the ONNX export) are used through their embed_documents method.
+    Args:
+        embeddings (Embeddings): The embedding model used for the vectorstore.
+        documents (list[Document]): The chunks to embed.
+    Returns:
+        numpy.ndarray: One normalized embedding per chunk, in the same order as `documents`.
+    """
+    texts = [doc.page_content for doc in documents]
+    if isinstance(embeddings, (PinnedInstructEmbeddings, PinnedHuggingFaceEmbeddings)):
+        return embeddings.encode_documents(texts, show_progress=True)
+    return np.asarray(embeddings.embed_documents(texts))
+
+
 @click.command()
 @click.option(
     "--device_type",
     default="cuda" if torch.cuda.is_available() else "cpu",
-    type=click.Choice(
-        [
-            "cpu",
-            "cuda",
-            "ipu",
-            "xpu",
-            "mkldnn",
-            "opengl",
-            "opencl",
-            "ideep",
-            "hip",
-            "ve",
-            "fpga",
-            "ort",
-            "xla",
-            "lazy",
-            "vulkan",
-            "mps",
-            "meta",
-            "hpu",
-            "mtia",
-        ],
-    ),
+    type=click.Choice(DEVICE_TYPES),
     help="Device to run on. (Default is cuda)",
 )
-
-def main(device_type):
+@click.option(
+    "--onnx",
+    is_flag=True,
+    help="Embed with the ONNX Runtime export from convert_to_onnx.py (Default is False)",
+)
+@click.option(
+    "--embedding_model",
+    default=EMBEDDING_MODEL_NAME,
+    help=f"Embedding model, run_localGPT.py has to use the same one. (Default is {EMBEDDING_MODEL_NAME})",
+)
+def main(device_type, onnx, embedding_model):
     # Take variable source directory because we're in a notebook
     source_directory = input('Source directory (type "default" for default): ')
     if source_directory == "default":
         source_directory = SOURCE_DIRECTORY
 
+    # Only files that were added or changed since the last ingest need to be loaded and embedded again
+    paths = find_documents(source_directory)
+    file_hashes = hash_files(paths)
+    manifest = load_manifest()
+    # The ONNX export is always of EMBEDDING_MODEL_NAME
+    embedding_config = {
+        "model": EMBEDDING_MODEL_NAME if onnx else embedding_model,
+        "backend": "onnx" if onnx else "torch",
+    }
+    changed, removed, rebuild = diff_manifest(manifest, file_hashes, source_directory, embedding_config)
+    if rebuild:
+        logging.info(
+            f"The vectorstore was embedded with {manifest['embeddings']}, embedding all documents again with "
+            f"{embedding_config}. Documents ingested from other directories have to be ingested again."
+        )
+    logging.info(f"Found {len(paths)} documents, {len(changed)} new or changed and {len(removed)} removed")
+    if not changed and not removed and not rebuild:
+        logging.info("The vectorstore is up to date")
+        return
+
     # Load documents and split in chunks
     logging.info(f"Loading documents from {source_directory}")
-    documents = load_documents(source_directory)
+    documents = load_documents(changed)
     text_documents, python_documents = split_documents(documents)
     text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
     python_splitter = RecursiveCharacterTextSplitter.from_language(
         language=Language.PYTHON, chunk_size=880, chunk_overlap=200
     )
-    texts = text_splitter.split_documents(text_documents)
-    texts.extend(python_splitter.split_documents(python_documents))
+    texts = split_in_parallel(text_splitter, text_documents)
+    texts.extend(split_in_parallel(python_splitter, python_documents))
     logging.info(f"Loaded {len(documents)} documents from {source_directory}")
     logging.info(f"Split into {len(texts)} chunks of text")
 
     # Create embeddings
-    logging.info("Using HuggingFaceInstructEmbeddings")
-    embeddings = HuggingFaceInstructEmbeddings(
-        model_name=EMBEDDING_MODEL_NAME,
-        model_kwargs={"device": device_type},
-    )
-    # change the embedding type here if you are running into issues.
-    # These are much smaller embeddings and will work for most appications
-    # If you use HuggingFaceEmbeddings, make sure to also use the same in the
-    # run_localGPT.py file.
-
-    # embeddings = HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL_NAME)
+    if onnx:
+        logging.info("Using OnnxInstructorEmbeddings")
+        embeddings = OnnxInstructorEmbeddings(device_type=device_type)
+    else:
+        logging.info(f"Using {embedding_model} embeddings")
+        # Use --embedding_model for a smaller model if you are running into issues.
+        # Make sure to also pass the same model to run_localGPT.py.
+        embeddings = load_embeddings(device_type, embedding_model)
 
-    db = Chroma.from_documents(
-        texts,
-        embeddings,
+    db = Chroma(
         persist_directory=PERSIST_DIRECTORY,
+        embedding_function=embeddings,
         client_settings=CHROMA_SETTINGS,
+        collection_metadata=CHROMA_COLLECTION_METADATA,
     )
-    
+    if rebuild:
+        # Recreate the collection, the new embeddings may have another dimension
+        db.delete_collection()
+        db = Chroma(
+            persist_directory=PERSIST_DIRECTORY,
+            embedding_function=embeddings,
+            client_settings=CHROMA_SETTINGS,
+            collection_metadata=CHROMA_COLLECTION_METADATA,
+        )
+    vectors = embed_documents(embeddings, texts) if texts else None
+    replace_chunks(db._collection, changed + removed, texts, vectors)
+    save_manifest(update_manifest(manifest, file_hashes, changed, removed, rebuild, embedding_config))
+
 
 if __name__ == "__main__":
     logging.basicConfig(
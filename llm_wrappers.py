@@ -0,0 +1,393 @@
+"""
+This file implements the LangChain LLM wrappers used around the locally loaded models.
+"""
+
+import copy
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+import torch
+from langchain.callbacks.manager import CallbackManagerForLLMRun
+from langchain.llms.base import LLM
+from langchain.llms.utils import enforce_stop_tokens
+from langchain.schema import Generation, LLMResult
+from transformers import (
+    DynamicCache,
+    LogitsProcessorList,
+    RepetitionPenaltyLogitsProcessor,
+    StoppingCriteria,
+    StoppingCriteriaList,
+    TextIteratorStreamer,
+)
+
+from constants import CONTEXT_WINDOW_SIZE
+
+
+def crop_cache(cache, length):
+    # DynamicCache can crop itself, the legacy cache format is a tuple of (key, value) pairs per layer
+    if hasattr(cache, "crop"):
+        cache.crop(length)
+        return cache
+    return tuple((key[:, :, :length], value[:, :, :length]) for key, value in cache)
+
+
+class CancelCriteria(StoppingCriteria):
+    # Stops generation once the event is set, so an interrupted answer does not keep decoding
+    def __init__(self, event):
+        self.event = event
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.full((input_ids.shape[0],), self.event.is_set(), dtype=torch.bool, device=input_ids.device)
+
+
+class ModelWorker:
+    """
+    Runs all work on a model on one persistent thread.
+    torch.compile's CUDA graphs are recorded per thread, so a graph captured while warming up in one thread
+    cannot be replayed by a generation in another. Prefilling, warming up and generating all go through
+    this worker, so the graphs are captured and replayed on the same thread.
+    """
+
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="model-worker")
+        self._thread = self._executor.submit(threading.current_thread).result()
+
+    def submit(self, fn, *args, **kwargs):
+        return self._executor.submit(fn, *args, **kwargs)
+
+    def run(self, fn, *args, **kwargs):
+        # Called from the worker itself, e.g. by a function that is already running on it
+        if threading.current_thread() is self._thread:
+            return fn(*args, **kwargs)
+        return self.submit(fn, *args, **kwargs).result()
+
+
+class CachedHuggingFaceLLM(LLM):
+    """
+    LLM that calls `model.generate` directly instead of going through a text-generation pipeline.
+    The pipeline rebuilds its pre and postprocessing on every call, so the logits processors, the stopping
+    criteria and a pinned input buffer are built once by `from_model` and reused by every call instead.
+    Answers are decoded greedily.
+    Every RetrievalQA prompt starts with the same system prompt, so it is prefilled once by `cache_prefix`
+    and each call only prefills the retrieved context and the question that follow it. The cache of the
+    previous prompt is kept as well, so a prompt that repeats it (the same documents, or a chat history
+    that only grew) also skips those tokens.
+    Tokens are passed to the callbacks as they are generated. Interrupting a call with Ctrl-C stops the
+    generation instead of letting it run to the end in the background.
+    Several prompts passed to `generate` (or `LLMChain.apply`) are generated together as one padded batch.
+    The model only runs on `worker`, pass other work on the model (e.g. compiling it) to `worker.run`.
+    """
+
+    model: Any  #: :meta private:
+    tokenizer: Any  #: :meta private:
+    generation_config: Any  #: :meta private:
+    logits_processor: Any = None  #: :meta private:
+    stopping_criteria: Any = None  #: :meta private:
+    cancel: Any = None  #: :meta private:
+    input_buffer: Any = None  #: :meta private:
+    worker: Any = None  #: :meta private:
+    prefix_ids: Any = None  #: :meta private:
+    prefix_cache: Any = None  #: :meta private:
+    last_ids: Any = None  #: :meta private:
+    last_cache: Any = None  #: :meta private:
+
+    @classmethod
+    def from_model(cls, model, tokenizer, generation_config, repetition_penalty=1.0, **kwargs):
+        """
+        Build the LLM and everything generate needs that does not change between calls.
+        Parameters:
+        - model (Union[PreTrainedModel, BaseGPTQForCausalLM]): The loaded model.
+        - tokenizer (PreTrainedTokenizer): The tokenizer of the model.
+        - generation_config (GenerationConfig): The generation config of the model, used for the token limits and
+          special tokens. It is switched to greedy decoding.
+        - repetition_penalty (float): Penalty for tokens that are already in the prompt or the answer. The
+          default of 1.0 leaves the processor out, so greedy decoding runs without any logits processor.
+        Returns:
+        - CachedHuggingFaceLLM: The LLM, kwargs (e.g. callbacks) are passed to the constructor.
+        """
+        if tokenizer.pad_token_id is None:
+            tokenizer.pad_token = tokenizer.eos_token
+        # Batches are generated at the end of the prompts
+        tokenizer.padding_side = "left"
+
+        # Sampling at temperature 0 is greedy decoding without the logits warpers
+        generation_config.do_sample = False
+        generation_config.temperature = None
+        generation_config.top_p = None
+        generation_config.top_k = None
+        generation_config.use_cache = True
+        generation_config.pad_token_id = tokenizer.pad_token_id
+        # generate refuses processors that it would also build from the config, so the penalty is only set here
+        generation_config.repetition_penalty = None
+
+        logits_processor = LogitsProcessorList()
+        if repetition_penalty and repetition_penalty != 1.0:
+            logits_processor.append(RepetitionPenaltyLogitsProcessor(penalty=repetition_penalty))
+        cancel = threading.Event()
+        stopping_criteria = StoppingCriteriaList([CancelCriteria(cancel)])
+
+        input_buffer = None
+        if model.device.type == "cuda":
+            # Prompts are staged here and copied to the GPU without waiting for the copy
+            input_buffer = torch.empty(CONTEXT_WINDOW_SIZE, dtype=torch.long).pin_memory()
+
+        return cls(
+            model=model,
+            tokenizer=tokenizer,
+            generation_config=generation_config,
+            logits_processor=logits_processor,
+            stopping_criteria=stopping_criteria,
+            cancel=cancel,
+            input_buffer=input_buffer,
+            worker=ModelWorker(),
+            **kwargs,
+        )
+
+    @property
+    def _llm_type(self) -> str:
+        return "huggingface_generate"
+
+    @property
+    def _identifying_params(self) -> Dict[str, Any]:
+        return {"model_id": self.model.config._name_or_path, "generation_config": self.generation_config.to_dict()}
+
+    def _to_device(self, prompt_ids):
+        if self.input_buffer is not None and len(prompt_ids) <= len(self.input_buffer):
+            staged = self.input_buffer[: len(prompt_ids)]
+            staged.copy_(prompt_ids)
+            return staged.to(self.model.device, non_blocking=True)
+        return prompt_ids.to(self.model.device)
+
+    def cache_prefix(self, prefix):
+        prefix_ids = self.tokenizer(prefix, return_tensors="pt").input_ids.to(self.model.device)
+        kwargs = {}
+        if getattr(self.model, "_supports_cache_class", False):
+            # Otherwise the model returns the legacy tuple format, which generate does not extend in place
+            kwargs["past_key_values"] = DynamicCache()
+
+        def prefill():
+            with torch.inference_mode():
+                return self.model(input_ids=prefix_ids, use_cache=True, **kwargs)
+
+        outputs = self.worker.run(prefill)
+        self.prefix_ids = prefix_ids[0]
+        self.prefix_cache = outputs.past_key_values
+
+    def warm_up(self, prompt, max_new_tokens=2):
+        # Generates without the callbacks and the cached prompts, only to load and tune the kernels
+        self.cancel.clear()
+        input_ids = self.tokenizer(prompt, return_tensors="pt").input_ids.to(self.model.device)
+        self.worker.run(
+            self.model.generate,
+            input_ids=input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            generation_config=self.generation_config,
+            logits_processor=self.logits_processor,
+            stopping_criteria=self.stopping_criteria,
+            max_new_tokens=max_new_tokens,
+        )
+
+    @staticmethod
+    def _common_length(ids, prompt_ids):
+        # The last cached tokens can merge with the text that follows them, so only reuse the tokens
+        # that match, and always leave at least one prompt token for generate to process.
+        n = min(len(ids), len(prompt_ids) - 1)
+        if n <= 0:
+            return 0
+        matches = prompt_ids[:n] == ids[:n]
+        return n if bool(matches.all()) else int(matches.int().argmin())
+
+    def _cache_for(self, prompt_ids):
+        candidates = [(self.prefix_ids, self.prefix_cache), (self.last_ids, self.last_cache)]
+        best, best_cache = 0, None
+        for ids, cache in candidates:
+            if cache is not None:
+                common = self._common_length(ids, prompt_ids)
+                if common > best:
+                    best, best_cache = common, cache
+        if best_cache is None:
+            return None
+        # generate extends the cache in place, so every call works on its own copy
+        cache = copy.deepcopy(best_cache)
+        return crop_cache(cache, best)
+
+    def _remember(self, prompt_ids, cache):
+        # A DynamicCache now also holds the prompt (and the answer, which is cropped off). Legacy tuple
+        # caches are converted by generate and not extended, so they cannot be reused this way.
+        if cache is not None and hasattr(cache, "get_seq_length") and cache.get_seq_length() >= len(prompt_ids):
+            self.last_ids = prompt_ids
+            self.last_cache = crop_cache(cache, len(prompt_ids))
+
+    def _call(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> str:
+        self.cancel.clear()
+        streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
+        prompt_ids = self._to_device(self.tokenizer(prompt, return_tensors="pt").input_ids[0])
+        input_ids = prompt_ids[None]
+        generate_kwargs = {
+            "input_ids": input_ids,
+            "attention_mask": torch.ones_like(input_ids),
+            "generation_config": self.generation_config,
+            "logits_processor": self.logits_processor,
+            "stopping_criteria": self.stopping_criteria,
+            "streamer": streamer,
+        }
+        cache = self._cache_for(prompt_ids) if self.prefix_cache is not None else None
+        if cache is not None:
+            generate_kwargs["past_key_values"] = cache
+
+        output_ids, errors = [], []
+
+        def generate():
+            try:
+                # auto-gptq models only take keyword arguments
+                output_ids.extend(self.model.generate(**generate_kwargs))
+            except Exception as e:
+                errors.append(e)
+                # Unblock the loop below
+                streamer.end()
+
+        future = self.worker.submit(generate)
+        try:
+            for token in streamer:
+                if run_manager:
+                    run_manager.on_llm_new_token(token)
+        except KeyboardInterrupt:
+            self.cancel.set()
+            future.result()
+            raise
+        future.result()
+        if errors:
+            raise errors[0]
+        if cache is not None:
+            self._remember(prompt_ids, cache)
+
+        text = self.tokenizer.decode(output_ids[0][len(prompt_ids) :], skip_special_tokens=True)
+        if stop:
+            text = enforce_stop_tokens(text, stop)
+        return text
+
+    def _generate(
+        self,
+        prompts: List[str],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> LLMResult:
+        if len(prompts) == 1:
+            return LLMResult(generations=[[Generation(text=self._call(prompts[0], stop, run_manager, **kwargs))]])
+
+        # The base class generates one prompt after the other, a batch keeps the GPU busy during decoding.
+        # The cached prefix has a batch size of one, so batches are prefilled from scratch and not streamed.
+        self.cancel.clear()
+        inputs = self.tokenizer(prompts, padding=True, return_tensors="pt").to(self.model.device)
+        output_ids = self.worker.run(
+            self.model.generate,
+            input_ids=inputs.input_ids,
+            attention_mask=inputs.attention_mask,
+            generation_config=self.generation_config,
+            logits_processor=self.logits_processor,
+            stopping_criteria=self.stopping_criteria,
+        )
+        texts = self.tokenizer.batch_decode(output_ids[:, inputs.input_ids.shape[1] :], skip_special_tokens=True)
+        generations = []
+        for text in texts:
+            if stop:
+                text = enforce_stop_tokens(text, stop)
+            generations.append([Generation(text=text)])
+        return LLMResult(generations=generations)
+
+
+class TensorRTLLM(LLM):
+    """
+    LLM that generates with a TensorRT-LLM engine through `tensorrt_llm.runtime.ModelRunner`.
+    The engine is built ahead of time (see the README), e.g. with int4 AWQ weights, and decodes greedily.
+    Tokens are passed to the callbacks as they are generated, and several prompts passed to `generate` are
+    generated together in batches of up to the engine's max batch size.
+    """
+
+    runner: Any  #: :meta private:
+    tokenizer: Any  #: :meta private:
+    max_new_tokens: int = 512
+    repetition_penalty: float = 1.0
+
+    @property
+    def _llm_type(self) -> str:
+        return "tensorrt_llm"
+
+    @property
+    def _identifying_params(self) -> Dict[str, Any]:
+        return {"model_id": self.tokenizer.name_or_path, "max_new_tokens": self.max_new_tokens}
+
+    def _generate_kwargs(self):
+        end_id = self.tokenizer.eos_token_id
+        pad_id = self.tokenizer.pad_token_id if self.tokenizer.pad_token_id is not None else end_id
+        return {
+            "max_new_tokens": self.max_new_tokens,
+            "end_id": end_id,
+            "pad_id": pad_id,
+            # top_k=1 is greedy decoding
+            "top_k": 1,
+            "repetition_penalty": self.repetition_penalty,
+            "output_sequence_lengths": True,
+            "return_dict": True,
+        }
+
+    def _tokenize(self, prompt):
+        return self.tokenizer(prompt, return_tensors="pt").input_ids[0].to(torch.int32)
+
+    def warm_up(self, prompt, max_new_tokens=2):
+        # Generates without the callbacks, only to initialize the engine's buffers
+        self.runner.generate([self._tokenize(prompt)], **{**self._generate_kwargs(), "max_new_tokens": max_new_tokens})
+
+    def _call(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> str:
+        input_ids = self._tokenize(prompt)
+        text = ""
+        # The outputs start with the prompt and grow by one token per step
+        for outputs in self.runner.generate([input_ids], streaming=True, **self._generate_kwargs()):
+            length = int(outputs["sequence_lengths"][0][0])
+            # Decode the whole answer so far, tokens can merge with the ones before them
+            answer_ids = outputs["output_ids"][0][0][len(input_ids) : length]
+            new_text = self.tokenizer.decode(answer_ids, skip_special_tokens=True)
+            if run_manager and len(new_text) > len(text):
+                run_manager.on_llm_new_token(new_text[len(text) :])
+            text = new_text
+        if stop:
+            text = enforce_stop_tokens(text, stop)
+        return text
+
+    def _generate(
+        self,
+        prompts: List[str],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> LLMResult:
+        if len(prompts) == 1:
+            return LLMResult(generations=[[Generation(text=self._call(prompts[0], stop, run_manager, **kwargs))]])
+
+        batch_size = getattr(self.runner, "max_batch_size", 1)
+        generations = []
+        for start in range(0, len(prompts), batch_size):
+            batch = [self._tokenize(prompt) for prompt in prompts[start : start + batch_size]]
+            outputs = self.runner.generate(batch, **self._generate_kwargs())
+            for i, input_ids in enumerate(batch):
+                length = int(outputs["sequence_lengths"][i][0])
+                answer_ids = outputs["output_ids"][i][0][len(input_ids) : length]
+                text = self.tokenizer.decode(answer_ids, skip_special_tokens=True)
+                if stop:
+                    text = enforce_stop_tokens(text, stop)
+                generations.append([Generation(text=text)])
+        return LLMResult(generations=generations)
@@ -1,15 +1,55 @@
+import functools
+import importlib.util
+import os
+
 import torch
-from auto_gptq import AutoGPTQForCausalLM
+from accelerate.hooks import remove_hook_from_module
+from accelerate import infer_auto_device_map, init_empty_weights
+from accelerate.utils import get_balanced_memory, send_to_device
+from auto_gptq import AutoGPTQForCausalLM, BaseQuantizeConfig
+from auto_gptq.modeling import BaseGPTQForCausalLM
+from auto_gptq.modeling._utils import find_layers, make_quant
+from auto_gptq.modeling.auto import GPTQ_CAUSAL_LM_MODEL_MAP
 from huggingface_hub import hf_hub_download
+from huggingface_hub.utils import LocalEntryNotFoundError
 from langchain.llms import LlamaCpp
 
 from transformers import (
+    AutoConfig,
     AutoModelForCausalLM,
     AutoTokenizer,
     LlamaForCausalLM,
     LlamaTokenizer,
 )
-from constants import CONTEXT_WINDOW_SIZE, MAX_NEW_TOKENS, N_GPU_LAYERS, N_BATCH, MODELS_PATH
+from constants import (
+    CONTEXT_WINDOW_SIZE,
+    CPU_OFFLOAD_MEMORY,
+    GPTQ_KERNEL,
+    GPU_MEMORY_FRACTION,
+    MAX_NEW_TOKENS,
+    N_GPU_LAYERS,
+    N_BATCH,
+    MODELS_PATH,
+    TRTLLM_ENGINE_DIRECTORY,
+)
+
+# Let the residual fp32 matmuls run on the TF32 tensor cores, and keep the fused flash kernel available to SDPA
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+torch.set_float32_matmul_precision("high")
+torch.backends.cuda.enable_flash_sdp(True)
+
+
+def download_model_file(model_id, filename):
+    """
+    Return the local path of a model file, downloading it only if it is not in MODELS_PATH yet.
+    Looking in the cache first skips the request to the HuggingFace Hub that checks for a newer revision on
+    every start.
+    """
+    try:
+        return hf_hub_download(repo_id=model_id, filename=filename, cache_dir=MODELS_PATH, local_files_only=True)
+    except LocalEntryNotFoundError:
+        return hf_hub_download(repo_id=model_id, filename=filename, resume_download=True, cache_dir=MODELS_PATH)
 
 
 def load_quantized_model_gguf_ggml(model_id, model_basename, device_type, logging):
@@ -26,37 +66,181 @@ def load_quantized_model_gguf_ggml(model_id, model_basename, device_type, loggin
     Returns:
     - LlamaCpp: An instance of the LlamaCpp model if successful, otherwise None.
     Notes:
-    - The function uses the `hf_hub_download` function to download the model from the HuggingFace Hub.
+    - The function uses `download_model_file` to download the model from the HuggingFace Hub on the first run.
     - The number of GPU layers is set based on the device type.
+    - On CUDA, llama.cpp uses its int8 (`__dp4a`) quantized matmul kernels by default, so GGUF k-quants such
+      as Q4_K_M or Q5_K_M are faster per token than GPTQ or fp16 on most cards.
     """
 
     try:
         logging.info("Using Llamacpp for GGUF/GGML quantized models")
-        model_path = hf_hub_download(
-            repo_id=model_id,
-            filename=model_basename,
-            resume_download=True,
-            cache_dir=MODELS_PATH,
-        )
+        model_path = download_model_file(model_id, model_basename)
         kwargs = {
             "model_path": model_path,
             "n_ctx": CONTEXT_WINDOW_SIZE,
             "max_tokens": MAX_NEW_TOKENS,
             "n_batch": N_BATCH,  # set this based on your GPU & CPU RAM
+            # One thread per physical core, hyperthreads only add contention in the matmul loops
+            "n_threads": max(1, (os.cpu_count() or 2) // 2),
         }
         if device_type.lower() == "mps":
-            kwargs["n_gpu_layers"] = 1
+            kwargs["n_gpu_layers"] = -1  # offload every layer to Metal
         if device_type.lower() == "cuda":
             kwargs["n_gpu_layers"] = N_GPU_LAYERS  # set this based on your GPU
 
-        return LlamaCpp(**kwargs)
+        llm = LlamaCpp(**kwargs)
     except:
         if "ggml" in model_basename:
-            logging.INFO("If you were using GGML model, LLAMA-CPP Dropped Support, Use GGUF Instead")
+            logging.info("If you were using GGML model, LLAMA-CPP Dropped Support, Use GGUF Instead")
+        return None
+
+    try:
+        # llama.cpp only reuses the KV cache of the previous prompt, the RAM cache keeps the states of
+        # earlier prompts so any of them can be restored when a new prompt starts with it
+        from llama_cpp import LlamaRAMCache
+
+        llm.client.set_cache(LlamaRAMCache(capacity_bytes=2 << 30))
+    except Exception as e:
+        logging.warning(f"Could not set up the llama.cpp prompt cache, running without it: {e}")
+    return llm
+
+
+class OffloadPrefetcher:
+    """
+    Overlap the CPU to GPU weight transfers of offloaded layers with the compute of the layer before them.
+    Accelerate moves an offloaded layer to the GPU when its forward starts and back to the CPU afterwards,
+    so every transfer stalls the GPU. Here the weights stay in pinned CPU memory, and while layer i runs,
+    the weights of the next offloaded layer are copied on a separate CUDA stream.
+    Parameters:
+    - modules (list[torch.nn.Module]): The offloaded modules, in the order they run.
+    - device (torch.device): The GPU the modules run on.
+    """
+
+    def __init__(self, modules, device):
+        self.device = device
+        self.stream = torch.cuda.Stream(device)
+        self.tensors = [list(module.parameters()) + list(module.buffers()) for module in modules]
+        self.pinned = [[tensor.data.pin_memory() for tensor in tensors] for tensors in self.tensors]
+        for tensors, pinned in zip(self.tensors, self.pinned):
+            for tensor, pinned_tensor in zip(tensors, pinned):
+                tensor.data = pinned_tensor
+        # Set while the weights of a module are on the GPU (or being copied there)
+        self.events = [None] * len(modules)
+
+        for i, module in enumerate(modules):
+            module.register_forward_pre_hook(functools.partial(self.pre_forward, i), with_kwargs=True)
+            module.register_forward_hook(functools.partial(self.post_forward, i))
+
+    def prefetch(self, i):
+        if self.events[i] is not None:
+            return
+        with torch.cuda.stream(self.stream):
+            for tensor, pinned in zip(self.tensors[i], self.pinned[i]):
+                tensor.data = pinned.to(self.device, non_blocking=True)
+            self.events[i] = self.stream.record_event()
+
+    def pre_forward(self, i, module, args, kwargs):
+        # Only the first offloaded layer of the first forward pass has not been prefetched
+        self.prefetch(i)
+        compute_stream = torch.cuda.current_stream(self.device)
+        compute_stream.wait_event(self.events[i])
+        for tensor in self.tensors[i]:
+            # The weights were allocated on the copy stream, keep them alive until the compute is done
+            tensor.data.record_stream(compute_stream)
+        # The last offloaded layer prefetches the first one for the next token
+        self.prefetch((i + 1) % len(self.tensors))
+        return send_to_device(args, self.device), send_to_device(kwargs, self.device)
+
+    def post_forward(self, i, module, args, output):
+        # The weights are not modified, so offloading is just pointing back at the pinned copies
+        for tensor, pinned in zip(self.tensors[i], self.pinned[i]):
+            tensor.data = pinned
+        self.events[i] = None
+
+
+def enable_offload_prefetch(model, logging):
+    """
+    Replace the accelerate CPU offload hooks of the model with an OffloadPrefetcher.
+    Parameters:
+    - model (transformers.PreTrainedModel): A model dispatched with a device map.
+    - logging (logging.Logger): Logger instance for logging messages.
+    Returns:
+    - OffloadPrefetcher: The prefetcher, or None if no layers are offloaded to the CPU.
+    """
+    device_map = getattr(model, "hf_device_map", None) or {}
+    offloaded = [name for name, device in device_map.items() if device == "cpu"]
+    gpus = [device for device in device_map.values() if device not in ["cpu", "disk"]]
+    if not offloaded or not gpus or not torch.cuda.is_available():
+        return None
+
+    device = torch.device("cuda", gpus[0]) if isinstance(gpus[0], int) else torch.device(gpus[0])
+    modules = [model.get_submodule(name) for name in offloaded]
+    for module in modules:
+        remove_hook_from_module(module)
+    logging.info(f"Prefetching {len(modules)} offloaded modules to {device}")
+    return OffloadPrefetcher(modules, device)
+
+
+def max_memory_per_device():
+    """
+    Memory budget for device_map="auto": GPU_MEMORY_FRACTION of every GPU and CPU_OFFLOAD_MEMORY of RAM.
+    Returns None without CUDA, which lets accelerate use its own defaults.
+    """
+    if not torch.cuda.is_available():
         return None
+    max_memory = {
+        i: f"{int(torch.cuda.get_device_properties(i).total_memory * GPU_MEMORY_FRACTION / 2**30)}GiB"
+        for i in range(torch.cuda.device_count())
+    }
+    max_memory["cpu"] = CPU_OFFLOAD_MEMORY
+    return max_memory
 
 
-def load_quantized_model_qptq(model_id, model_basename, device_type, logging):
+def gptq_device_map(model_id, max_memory, logging):
+    """
+    The device map device_map="auto" gives a GPTQ model within the `max_memory` budget.
+    This takes the same steps as auto-gptq's from_quantized: the model is built without weights, its linear
+    layers are replaced by quantized ones and accelerate places the decoder layers, so the result is the
+    placement the model is loaded with. Only the sizes matter, so the quantized layers of the CUDA kernel
+    stand in for every kernel.
+    Returns None without a budget or if the map could not be computed, device_map="auto" is used then.
+    """
+    if max_memory is None:
+        return None
+    try:
+        config = AutoConfig.from_pretrained(model_id, trust_remote_code=True)
+        gptq_class = GPTQ_CAUSAL_LM_MODEL_MAP[config.model_type]
+        quantize_config = BaseQuantizeConfig.from_pretrained(model_id)
+        with init_empty_weights(include_buffers=True):
+            model = AutoModelForCausalLM.from_config(config, trust_remote_code=True, torch_dtype=torch.float16)
+            layers = find_layers(model)
+            outside_layers = [gptq_class.lm_head_name] + gptq_class.outside_layer_modules
+            inside_layers = [name for names in gptq_class.inside_layer_modules for name in names]
+            for name in list(layers):
+                if any(name.startswith(layer) for layer in outside_layers) or not any(
+                    name.endswith(layer) for layer in inside_layers
+                ):
+                    del layers[name]
+            make_quant(
+                model,
+                layers,
+                quantize_config.bits,
+                quantize_config.group_size,
+                use_triton=False,
+                disable_exllama=True,
+                disable_exllamav2=True,
+                desc_act=quantize_config.desc_act,
+            )
+        model.tie_weights()
+        no_split = [gptq_class.layer_type]
+        balanced_memory = get_balanced_memory(model, max_memory=max_memory, no_split_module_classes=no_split)
+        return infer_auto_device_map(model, max_memory=balanced_memory, no_split_module_classes=no_split)
+    except Exception as e:
+        logging.info(f"Could not compute the device map of {model_id}, using device_map=auto: {e}")
+        return None
+
+
+def load_quantized_model_qptq(model_id, model_basename, device_type, logging, kernel=GPTQ_KERNEL):
     """
     Load a GPTQ quantized model using AutoGPTQForCausalLM.
     This function loads a quantized model that ends with GPTQ and may have variations
@@ -66,11 +250,20 @@ def load_quantized_model_qptq(model_id, model_basename, device_type, logging):
     - model_basename (str): The base name of the model file.
     - device_type (str): The type of device where the model will run.
     - logging (logging.Logger): Logger instance for logging messages.
+    - kernel (str): The int4 matmul kernel, one of GPTQ_KERNELS.
     Returns:
     - model (AutoGPTQForCausalLM): The loaded quantized model.
     - tokenizer (AutoTokenizer): The tokenizer associated with the model.
     Notes:
     - The function checks for the ".safetensors" ending in the model_basename and removes it if present.
+    - The exllama, exllamav2 and marlin kernels dequantize inside the matmul, so the weights are read as int4.
+      Marlin checkpoints are repacked by auto-gptq on the first load and cached next to the model.
+    - auto-gptq's fused attention is not injected: it calls the Llama rotary embedding with the `seq_len`
+      argument that transformers>=4.44 removed, so the model would fail on its first forward pass.
+    - The layers are spread over all GPUs within `max_memory_per_device`, so a model that is slightly too big
+      for one GPU uses the next one instead of being offloaded to the CPU.
+    - The exllama, exllamav2 and marlin kernels only run on layers that are on a GPU. When the device map from
+      `gptq_device_map` offloads part of the model to the CPU, the triton kernel is used instead.
     """
 
     # The code supports all huggingface models that ends with GPTQ and have some variation
@@ -84,19 +277,162 @@ def load_quantized_model_qptq(model_id, model_basename, device_type, logging):
     tokenizer = AutoTokenizer.from_pretrained(model_id, use_fast=True)
     logging.info("Tokenizer loaded")
 
+    max_memory = max_memory_per_device()
+    device_map = gptq_device_map(model_id, max_memory, logging)
+    offloaded = device_map is not None and any(device in ("cpu", "disk") for device in device_map.values())
+    if kernel != "triton" and offloaded:
+        logging.warning(
+            f"The model does not fit on the GPU and is partly offloaded to the CPU, which the {kernel} kernel "
+            "does not support, using triton instead"
+        )
+        kernel = "triton"
+
+    kernel_kwargs = {
+        "exllama": {"disable_exllama": False, "disable_exllamav2": True},
+        "exllamav2": {"disable_exllama": True, "disable_exllamav2": False},
+        "marlin": {"use_marlin": True},
+        "triton": {"use_triton": True, "disable_exllama": True, "disable_exllamav2": True},
+    }[kernel]
+    logging.info(f"Using {kernel} kernels")
+
     model = AutoGPTQForCausalLM.from_quantized(
         model_id,
         model_basename=model_basename,
         use_safetensors=True,
         trust_remote_code=True,
-        device_map="auto",
-        use_triton=False,
+        # The placement the kernel was chosen for, auto-gptq ignores max_memory with a device map
+        device_map=device_map if device_map is not None else "auto",
+        max_memory=max_memory,
         quantize_config=None,
+        **kernel_kwargs,
     )
+    if device_type.lower() == "cuda":
+        # Layers that do not fit on the GPU are offloaded to the CPU, overlap their transfers with compute
+        enable_offload_prefetch(model.model, logging)
     return model, tokenizer
 
 
-def load_full_model(model_id, model_basename, device_type, logging):
+def compile_model(model, device_type, logging):
+    """
+    Compile the forward pass of a full model with torch.compile (PyTorch 2.x).
+    Inductor fuses the pointwise ops around the matmuls (RMSNorm, residual adds, SiLU) into fewer kernels.
+    Only the forward method is compiled, so `generate` and the HF model attributes are untouched. CUDA graphs
+    are not used, every new sequence length would capture another one (see `compile_with_static_cache`).
+    Parameters:
+    - model (transformers.PreTrainedModel): The model to compile in place.
+    - device_type (str): "cuda" or "cpu". Other devices are not supported by Inductor and are left as is.
+    - logging (logging.Logger): Logger instance for logging messages.
+    """
+    if not hasattr(torch, "compile") or device_type.lower() not in ("cuda", "cpu"):
+        return model
+    logging.info("Compiling the model with torch.compile")
+    # Prompts have different lengths, so compile for dynamic shapes instead of recompiling per length
+    model.forward = torch.compile(model.forward, mode="default", dynamic=True)
+    return model
+
+
+def compile_with_static_cache(model, tokenizer, generation_config, logging):
+    """
+    Compile the forward pass for a static KV cache and capture it in CUDA graphs.
+    With a static cache every decoding step has the same shapes, so the forward pass of a full model can be
+    compiled into one graph and replayed without per-kernel launch overhead. The custom ops of the GPTQ
+    kernels break the graph, so GPTQ models are compiled into several graphs around them.
+    The model is warmed up twice so compilation and CUDA graph capture happen before the first question.
+    Parameters:
+    - model (Union[PreTrainedModel, BaseGPTQForCausalLM]): The model to compile in place.
+    - tokenizer (PreTrainedTokenizer): The tokenizer of the model.
+    - generation_config (GenerationConfig): The generation config the LLM will use.
+    - logging (logging.Logger): Logger instance for logging messages.
+    Returns:
+    - bool: True if the model was compiled, False if compilation failed and the model runs eagerly.
+    Notes:
+    - A static cache cannot be combined with a prefilled `past_key_values`, so prefix caching is not available.
+    - The warmup prompt fills the context window so the cache is allocated at CONTEXT_WINDOW_SIZE once and
+      reused by every later call.
+    - The CUDA graphs belong to the thread that captures them, so this has to run on the thread that will
+      generate, i.e. through `CachedHuggingFaceLLM.worker.run`.
+    """
+    # auto-gptq wraps the transformers model
+    hf_model = model.model if isinstance(model, BaseGPTQForCausalLM) else model
+    forward = hf_model.forward
+    logging.info("Compiling the model with a static KV cache, this can take a few minutes")
+    generation_config.cache_implementation = "static"
+    fullgraph = not isinstance(model, BaseGPTQForCausalLM)
+    hf_model.forward = torch.compile(forward, mode="reduce-overhead", fullgraph=fullgraph, dynamic=False)
+    try:
+        token_id = tokenizer.eos_token_id if tokenizer.eos_token_id is not None else 0
+        input_ids = torch.full((1, CONTEXT_WINDOW_SIZE - 2), token_id, dtype=torch.long, device=model.device)
+        for _ in range(2):
+            model.generate(
+                input_ids=input_ids,
+                attention_mask=torch.ones_like(input_ids),
+                generation_config=generation_config,
+                max_new_tokens=2,
+                min_new_tokens=2,
+            )
+    except Exception as e:
+        logging.info(f"Compilation failed, running the model eagerly: {e}")
+        hf_model.forward = forward
+        generation_config.cache_implementation = None
+        return False
+    return True
+
+
+def enable_quantized_kv_cache(model, generation_config, logging):
+    """
+    Store the KV cache in int8 with the HQQ backend instead of fp16.
+    Decoding reads the whole KV cache for every token, so an int8 cache halves that traffic and the memory
+    of long contexts. The most recent tokens are kept in full precision until they are quantized in groups.
+    Parameters:
+    - model (Union[PreTrainedModel, BaseGPTQForCausalLM]): The loaded model.
+    - generation_config (GenerationConfig): The generation config the LLM will use.
+    - logging (logging.Logger): Logger instance for logging messages.
+    Returns:
+    - bool: True if the cache is quantized, False if the model or the environment does not support it.
+    Notes:
+    - A quantized cache cannot be combined with a prefilled `past_key_values`, so prefix caching is not available.
+    """
+    if not getattr(model, "_supports_quantized_cache", False):
+        logging.info("This model does not support a quantized KV cache")
+        return False
+    if importlib.util.find_spec("hqq") is None:
+        logging.info("A quantized KV cache needs the hqq package, `pip install hqq`")
+        return False
+    # Only needed for this opt-in cache
+    from transformers import QuantizedCacheConfig
+
+    logging.info("Quantizing the KV cache to int8")
+    generation_config.cache_implementation = "quantized"
+    generation_config.cache_config = QuantizedCacheConfig(backend="HQQ", nbits=8, device=str(model.device))
+    return True
+
+
+def load_trtllm_engine(model_id, logging):
+    """
+    Load the TensorRT-LLM engine built for a full model.
+    Parameters:
+    - model_id (str): The HuggingFace model the engine was built from, its tokenizer is used.
+    - logging (logging.Logger): Logger instance for logging messages.
+    Returns:
+    - Tuple[ModelRunner, AutoTokenizer]: The engine runner and the tokenizer, or None if tensorrt_llm is not
+      installed or no engine was built in TRTLLM_ENGINE_DIRECTORY.
+    """
+    if not os.path.isdir(TRTLLM_ENGINE_DIRECTORY):
+        logging.info(f"No TensorRT-LLM engine in {TRTLLM_ENGINE_DIRECTORY}, see the README to build one")
+        return None
+    try:
+        from tensorrt_llm.runtime import ModelRunner
+    except ImportError:
+        logging.info("TensorRT-LLM is not installed, `pip install tensorrt_llm`")
+        return None
+
+    logging.info(f"Loading the TensorRT-LLM engine from {TRTLLM_ENGINE_DIRECTORY}")
+    runner = ModelRunner.from_dir(engine_dir=TRTLLM_ENGINE_DIRECTORY)
+    tokenizer = AutoTokenizer.from_pretrained(model_id, use_fast=True)
+    return runner, tokenizer
+
+
+def load_full_model(model_id, model_basename, device_type, logging, compile_forward=False):
     """
     Load a full model using either LlamaTokenizer or AutoModelForCausalLM.
     This function loads a full model based on the specified device type.
@@ -107,6 +443,7 @@ def load_full_model(model_id, model_basename, device_type, logging):
     - model_basename (str): The base name of the model file.
     - device_type (str): The type of device where the model will run.
     - logging (logging.Logger): Logger instance for logging messages.
+    - compile_forward (bool): Compile the forward pass with dynamic shapes, see `compile_model`.
     Returns:
     - model (Union[LlamaForCausalLM, AutoModelForCausalLM]): The loaded model.
     - tokenizer (Union[LlamaTokenizer, AutoTokenizer]): The tokenizer associated with the model.
@@ -118,15 +455,28 @@ def load_full_model(model_id, model_basename, device_type, logging):
     if device_type.lower() in ["mps", "cpu"]:
         logging.info("Using LlamaTokenizer")
         tokenizer = LlamaTokenizer.from_pretrained(model_id, cache_dir="./models/")
-        model = LlamaForCausalLM.from_pretrained(model_id, cache_dir="./models/")
+        # Load the weights straight into half precision instead of materializing them in float32 first
+        model = LlamaForCausalLM.from_pretrained(
+            model_id,
+            cache_dir="./models/",
+            low_cpu_mem_usage=True,
+            torch_dtype=torch.float16 if device_type.lower() == "mps" else torch.bfloat16,
+        )
+        if compile_forward:
+            compile_model(model, device_type, logging)
     else:
         logging.info("Using AutoModelForCausalLM for full models")
         tokenizer = AutoTokenizer.from_pretrained(model_id, cache_dir="./models/")
         logging.info("Tokenizer loaded")
+        # FlashAttention-2 needs the flash-attn package, PyTorch's fused SDPA kernels are the fallback
+        attn_implementation = "flash_attention_2" if importlib.util.find_spec("flash_attn") else "sdpa"
+        logging.info(f"Using {attn_implementation} attention")
+        logging.info(f"Flash SDPA enabled: {torch.backends.cuda.flash_sdp_enabled()}")
         model = AutoModelForCausalLM.from_pretrained(
             model_id,
             device_map="auto",
             torch_dtype=torch.float16,
+            attn_implementation=attn_implementation,
             low_cpu_mem_usage=True,
             cache_dir=MODELS_PATH,
             trust_remote_code=True, # set these if you are using NVIDIA GPU
@@ -136,4 +486,8 @@ def load_full_model(model_id, model_basename, device_type, logging):
             max_memory={0: "15GB"} # Uncomment this line with you encounter CUDA out of memory errors
         )
         model.tie_weights()
+        if compile_forward:
+            compile_model(model, device_type, logging)
+    # Decoder-only models generate after the last token, so padding has to go on the left
+    tokenizer.padding_side = "left"
     return model, tokenizer
\ No newline at end of file
@@ -3,12 +3,19 @@ import subprocess
 import streamlit as st
 from run_localGPT import load_model
 from langchain.vectorstores import Chroma
-from constants import CHROMA_SETTINGS, EMBEDDING_MODEL_NAME, PERSIST_DIRECTORY, MODEL_ID, MODEL_BASENAME
+from constants import (
+    CHROMA_SETTINGS,
+    EMBEDDING_MODEL_NAME,
+    HISTORY_WINDOW_SIZE,
+    PERSIST_DIRECTORY,
+    MODEL_ID,
+    MODEL_BASENAME,
+)
 from langchain.embeddings import HuggingFaceInstructEmbeddings
 from langchain.chains import RetrievalQA
 from streamlit_extras.add_vertical_space import add_vertical_space
 from langchain.prompts import PromptTemplate
-from langchain.memory import ConversationBufferMemory
+from langchain.memory import ConversationBufferWindowMemory
 
 
 
@@ -22,7 +29,7 @@ def model_memory():
     Helpful Answer:"""
 
     prompt = PromptTemplate(input_variables=["history", "context", "question"], template=template)
-    memory = ConversationBufferMemory(input_key="question", memory_key="history")
+    memory = ConversationBufferWindowMemory(k=HISTORY_WINDOW_SIZE, input_key="question", memory_key="history")
 
     return prompt, memory
 
@@ -0,0 +1,36 @@
+"""
+This file implements the PDF loader used by ingest.py.
+"""
+
+from typing import List
+
+import pypdfium2 as pdfium
+from langchain.docstore.document import Document
+from langchain.document_loaders.base import BaseLoader
+
+
+class PyPDFium2Loader(BaseLoader):
+    """
+    Load a PDF with PDFium, which extracts text in C and is several times faster than pdfminer.
+    load_single_document keeps only the first Document a loader returns, so unlike langchain's
+    PyPDFium2Loader the text of all pages is returned as a single Document.
+    Parameters:
+    - file_path (str): Path to the PDF file.
+    """
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+
+    def load(self) -> List[Document]:
+        pages = []
+        pdf = pdfium.PdfDocument(self.file_path)
+        try:
+            for page in pdf:
+                textpage = page.get_textpage()
+                pages.append(textpage.get_text_range())
+                # PDFium objects have to be closed child first, or they can crash when garbage collected
+                textpage.close()
+                page.close()
+        finally:
+            pdf.close()
+        return [Document(page_content="\n".join(pages), metadata={"source": self.file_path})]
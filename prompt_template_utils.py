@@ -4,9 +4,9 @@ Modify the prompt template based on the model you select.
 This seems to have significant impact on the output of the LLM.
 '''
 
-from langchain.memory import ConversationBufferMemory
+from langchain.memory import ConversationBufferWindowMemory
 from langchain.prompts import PromptTemplate
-from constants import TEMPLATE
+from constants import HISTORY_WINDOW_SIZE, TEMPLATE
 
 # this is specific to Llama-2. 
 
@@ -88,6 +88,7 @@ def get_prompt_template(system_prompt=TEMPLATE, promptTemplate_type=None, histor
             Helpful Answer:"""
             prompt = PromptTemplate(input_variables=["context", "question"], template=prompt_template)
 
-    memory = ConversationBufferMemory(input_key="question", memory_key="history")
+    # Only the last turns are kept, older ones would be prefilled again on every question
+    memory = ConversationBufferWindowMemory(k=HISTORY_WINDOW_SIZE, input_key="question", memory_key="history")
 
     return prompt, memory, 
\ No newline at end of file
@@ -0,0 +1,154 @@
+"""
+This file implements an HTTP query service that batches concurrent questions.
+It is started with `python run_localGPT.py --server` (or `python query_service.py`, which takes the same options).
+Queries arriving within a short collection window are embedded in a single forward pass, their documents are
+retrieved concurrently, and the LLM generates all the answers of the batch together.
+"""
+
+import asyncio
+import contextlib
+import logging
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import uvicorn
+from fastapi import FastAPI
+from pydantic import BaseModel
+
+from embedding_utils import embed_queries
+
+
+class QueryRequest(BaseModel):
+    query: str
+
+
+async def gather_with_timeout(queue, max_size, timeout):
+    """
+    Wait for the next item on the queue, then keep collecting items until `max_size` items are gathered
+    or `timeout` seconds have passed since the first one arrived.
+    """
+    loop = asyncio.get_running_loop()
+    batch = [await queue.get()]
+    deadline = loop.time() + timeout
+    while len(batch) < max_size:
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            break
+        try:
+            batch.append(await asyncio.wait_for(queue.get(), remaining))
+        except asyncio.TimeoutError:
+            break
+    return batch
+
+
+class QueryBatcher:
+    """
+    Collects queries from concurrent requests and answers them as a batch.
+    Parameters:
+    - qa (RetrievalQA): The QA chain from `retrieval_qa_pipline`. Its retriever provides the vectorstore and
+      embeddings, and its combine_documents_chain builds the prompts and answers them.
+    - max_batch_size (int): Maximum number of queries answered together.
+    - timeout (float): Collection window in seconds, measured from the first query of a batch.
+    Notes:
+    - Batches are answered one after the other; queries arriving meanwhile wait for the next batch.
+    - The LLM runs on a single thread of its own through the synchronous `LLMChain.apply`, which sends the
+      whole batch to one `generate` call. `aapply` would generate every prompt separately.
+    """
+
+    def __init__(self, qa, max_batch_size=32, timeout=0.050):
+        self.qa = qa
+        self.db = qa.retriever.vectorstore
+        self.k = qa.retriever.search_kwargs.get("k", 4)
+        self.max_batch_size = max_batch_size
+        self.timeout = timeout
+        self.queue = asyncio.Queue()
+        self.llm_executor = ThreadPoolExecutor(max_workers=1)
+
+    async def submit(self, query):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((query, future))
+        return await future
+
+    async def run(self):
+        while True:
+            batch = await gather_with_timeout(self.queue, self.max_batch_size, self.timeout)
+            queries = [query for query, _ in batch]
+            try:
+                results = await self._answer(queries)
+            except Exception as e:
+                results = [e] * len(batch)
+            for (_, future), result in zip(batch, results):
+                # The request may have been cancelled by the client in the meantime
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    async def _answer(self, queries):
+        vectors = await asyncio.to_thread(embed_queries, self.db.embeddings, queries)
+        docs = await asyncio.gather(
+            *(asyncio.to_thread(self.db.similarity_search_by_vector, vector, k=self.k) for vector in vectors)
+        )
+        combine_chain = self.qa.combine_documents_chain
+        inputs = [combine_chain._get_inputs(query_docs, question=query) for query, query_docs in zip(queries, docs)]
+        loop = asyncio.get_running_loop()
+        outputs = await loop.run_in_executor(self.llm_executor, combine_chain.llm_chain.apply, inputs)
+        return [
+            {
+                "Prompt": query,
+                "Answer": output[combine_chain.llm_chain.output_key],
+                "Sources": [
+                    (os.path.basename(str(doc.metadata["source"])), str(doc.page_content)) for doc in query_docs
+                ],
+            }
+            for query, query_docs, output in zip(queries, docs, outputs)
+        ]
+
+
+def log_batcher_exit(task):
+    if not task.cancelled() and task.exception() is not None:
+        logging.error("The query batcher stopped", exc_info=task.exception())
+
+
+def create_app(qa):
+    batcher = QueryBatcher(qa)
+
+    @contextlib.asynccontextmanager
+    async def lifespan(app):
+        # Keep a reference to the task, the event loop only holds a weak one
+        app.state.batcher_task = asyncio.create_task(batcher.run())
+        app.state.batcher_task.add_done_callback(log_batcher_exit)
+        try:
+            yield
+        finally:
+            # A batcher that stopped with an exception has already logged it
+            if not app.state.batcher_task.done():
+                app.state.batcher_task.cancel()
+                with contextlib.suppress(asyncio.CancelledError):
+                    await app.state.batcher_task
+            batcher.llm_executor.shutdown(wait=False)
+
+    app = FastAPI(lifespan=lifespan)
+
+    @app.post("/query")
+    async def query_route(request: QueryRequest):
+        return await batcher.submit(request.query)
+
+    return app
+
+
+def serve(qa, host="127.0.0.1", port=5112):
+    uvicorn.run(create_app(qa), host=host, port=port)
+
+
+if __name__ == "__main__":
+    # run_localGPT.py is the single entry point, so both take the same options
+    from run_localGPT import main
+
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(filename)s:%(lineno)s - %(message)s", level=logging.INFO
+    )
+    main(["--server", *sys.argv[1:]])
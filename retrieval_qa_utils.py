@@ -0,0 +1,84 @@
+"""
+This file implements the RetrievalQA chain used by run_localGPT.py, with the prompt templates compiled once.
+"""
+
+import string
+from typing import Any, Dict, Optional
+
+from langchain.callbacks.manager import CallbackManagerForChainRun
+from langchain.chains import RetrievalQA
+from langchain.chains.combine_documents.stuff import StuffDocumentsChain
+from langchain.prompts import PromptTemplate
+
+
+def compile_template(template):
+    """
+    Compile an f-string prompt template into a function that fills it in from a dict of values.
+    The template is parsed once, filling it in is a single join. Returns None for templates that use
+    conversions or format specs, which are left to PromptTemplate.format.
+    """
+    pieces = []
+    for literal, field, format_spec, conversion in string.Formatter().parse(template):
+        if format_spec or conversion:
+            return None
+        pieces.append((literal, field))
+
+    def format(values):
+        return "".join(literal + (str(values[field]) if field is not None else "") for literal, field in pieces)
+
+    return format
+
+
+def _is_plain_template(prompt):
+    return isinstance(prompt, PromptTemplate) and prompt.template_format == "f-string" and not prompt.partial_variables
+
+
+class PrecompiledRetrievalQA(RetrievalQA):
+    """
+    RetrievalQA that formats the "stuff" prompt with compiled templates.
+    The stuff chain formats every document and the prompt through PromptTemplate.format (which validates its
+    inputs each time) and runs the LLMChain and the memory through their own chain calls. Here the templates
+    are compiled on the first call and the prompt is passed straight to the LLM, the answer and the memory
+    are the same. Other chain types, or templates that cannot be compiled, use RetrievalQA as is.
+    """
+
+    format_prompt: Any = None  #: :meta private:
+    format_document: Any = None  #: :meta private:
+
+    def _compile(self):
+        combine_chain = self.combine_documents_chain
+        if self.format_prompt is None and isinstance(combine_chain, StuffDocumentsChain):
+            prompt, document_prompt = combine_chain.llm_chain.prompt, combine_chain.document_prompt
+            if _is_plain_template(prompt) and _is_plain_template(document_prompt):
+                self.format_document = compile_template(document_prompt.template)
+                self.format_prompt = compile_template(prompt.template)
+        return self.format_prompt is not None and self.format_document is not None
+
+    def _call(
+        self,
+        inputs: Dict[str, Any],
+        run_manager: Optional[CallbackManagerForChainRun] = None,
+    ) -> Dict[str, Any]:
+        if not self._compile():
+            return super()._call(inputs, run_manager)
+
+        _run_manager = run_manager or CallbackManagerForChainRun.get_noop_manager()
+        question = inputs[self.input_key]
+        docs = self._get_docs(question, run_manager=_run_manager)
+
+        combine_chain = self.combine_documents_chain
+        values = {"question": question}
+        if combine_chain.memory is not None:
+            values.update(combine_chain.memory.load_memory_variables({"question": question}))
+        values[combine_chain.document_variable_name] = combine_chain.document_separator.join(
+            self.format_document({"page_content": doc.page_content, **doc.metadata}) for doc in docs
+        )
+        answer = combine_chain.llm_chain.llm.predict(self.format_prompt(values), callbacks=_run_manager.get_child())
+        if combine_chain.memory is not None:
+            combine_chain.memory.save_context(
+                {"input_documents": docs, "question": question}, {combine_chain.output_key: answer}
+            )
+
+        if self.return_source_documents:
+            return {self.output_key: answer, "source_documents": docs}
+        return {self.output_key: answer}
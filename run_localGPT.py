@@ -1,32 +1,45 @@
+import contextlib
 import os
 import logging
+import sys
+import threading
 import click
 import torch
-from langchain.chains import RetrievalQA
-from langchain.embeddings import HuggingFaceInstructEmbeddings
-from langchain.llms import HuggingFacePipeline
+from prompt_toolkit import PromptSession
+from prompt_toolkit.patch_stdout import patch_stdout
 from langchain.callbacks.streaming_stdout import StreamingStdOutCallbackHandler  # for streaming response
 from langchain.callbacks.manager import CallbackManager
+from langchain.llms import LlamaCpp
 
 callback_manager = CallbackManager([StreamingStdOutCallbackHandler()])
 
 from prompt_template_utils import get_prompt_template
+from retrieval_qa_utils import PrecompiledRetrievalQA
+from embedding_utils import CachedQueryEmbeddings, check_embedding_parity, load_query_embeddings
+from llm_wrappers import CachedHuggingFaceLLM, TensorRTLLM
+from vectorstore_utils import load_faiss_vectorstore, load_mmap_vectorstore
 
 from langchain.vectorstores import Chroma
-from transformers import (
-    GenerationConfig,
-    pipeline,
-)
+from transformers import GenerationConfig
 
 from load_models import (
+    compile_with_static_cache,
+    enable_quantized_kv_cache,
     load_quantized_model_gguf_ggml,
     load_quantized_model_qptq,
     load_full_model,
+    load_trtllm_engine,
 )
 
 from constants import (
+    COMPILE_MODES,
+    DEVICE_TYPES,
     EMBEDDING_MODEL_NAME,
+    ENGINES,
+    GPTQ_KERNEL,
+    GPTQ_KERNELS,
     PERSIST_DIRECTORY,
+    VECTORSTORES,
     MODEL_ID,
     MODEL_BASENAME,
     MAX_NEW_TOKENS,
@@ -34,7 +47,17 @@ from constants import (
 )
 
 
-def load_model(device_type, model_id, model_basename=None, LOGGING=logging):
+def load_model(
+    device_type,
+    model_id,
+    model_basename=None,
+    LOGGING=logging,
+    kernel=GPTQ_KERNEL,
+    compile_mode="none",
+    quantize_kv_cache=False,
+    repetition_penalty=1.0,
+    engine="hf",
+):
     """
     Select a model for text generation using the HuggingFace library.
     If you are running this for the first time, it will download a model for you.
@@ -44,8 +67,15 @@ def load_model(device_type, model_id, model_basename=None, LOGGING=logging):
         model_id (str): Identifier of the model to load from HuggingFace's model hub.
         model_basename (str, optional): Basename of the model if using quantized models.
             Defaults to None.
+        kernel (str, optional): Matmul kernel for GPTQ models. Defaults to GPTQ_KERNEL.
+        compile_mode (str, optional): One of COMPILE_MODES. "dynamic" compiles the forward pass of full
+            models for any prompt length, "static" compiles the model with a static KV cache. Defaults to "none".
+        quantize_kv_cache (bool, optional): Store the KV cache in int8. Defaults to False.
+        repetition_penalty (float, optional): Penalty for repeated tokens, 1.0 disables it. Defaults to 1.0.
+        engine (str, optional): "trtllm" runs full models with their TensorRT-LLM engine, falling back to
+            HuggingFace if none was built. Defaults to "hf".
     Returns:
-        HuggingFacePipeline: A pipeline object for text generation using the loaded model.
+        LLM: A LangChain LLM for text generation using the loaded model.
     Raises:
         ValueError: If an unsupported model or device type is provided.
     """
@@ -53,41 +83,72 @@ def load_model(device_type, model_id, model_basename=None, LOGGING=logging):
     logging.info("This action can take a few minutes!")
 
     if model_basename is not None:
-        if ".gguf" in model_basename.lower():
+        # Old GGML files are named like "llama-2-7b-chat.ggmlv3.q4_0.bin", so match anywhere in the name
+        if ".gguf" in model_basename.lower() or ".ggml" in model_basename.lower():
             llm = load_quantized_model_gguf_ggml(model_id, model_basename, device_type, LOGGING)
+            if llm is not None:
+                llm.callbacks = [StreamingStdOutCallbackHandler()]
             return llm
-        elif ".ggml" in model_basename.lower():
-            model, tokenizer = load_quantized_model_gguf_ggml(model_id, model_basename, device_type, LOGGING)
         else:
-            model, tokenizer = load_quantized_model_qptq(model_id, model_basename, device_type, LOGGING)
+            model, tokenizer = load_quantized_model_qptq(model_id, model_basename, device_type, LOGGING, kernel)
     else:
-        model, tokenizer = load_full_model(model_id, model_basename, device_type, LOGGING)
+        if engine == "trtllm":
+            engine_runner = load_trtllm_engine(model_id, LOGGING)
+            if engine_runner is not None:
+                runner, tokenizer = engine_runner
+                logging.info("Local LLM Loaded")
+                return TensorRTLLM(
+                    runner=runner,
+                    tokenizer=tokenizer,
+                    max_new_tokens=MAX_NEW_TOKENS,
+                    repetition_penalty=repetition_penalty,
+                    callbacks=[StreamingStdOutCallbackHandler()],
+                )
+        model, tokenizer = load_full_model(
+            model_id, model_basename, device_type, LOGGING, compile_forward=compile_mode == "dynamic"
+        )
 
     # Load configuration from the model to avoid warnings
     generation_config = GenerationConfig.from_pretrained(model_id)
     # see here for details:
     # https://huggingface.co/docs/transformers/
     # main_classes/text_generation#transformers.GenerationConfig.from_pretrained.returns
+    generation_config.max_new_tokens = MAX_NEW_TOKENS
 
-    # Create a pipeline for text generation
-    pipe = pipeline(
-        "text-generation",
-        model=model,
-        tokenizer=tokenizer,
-        max_length=MAX_NEW_TOKENS,
-        do_sample=True,
-        temperature=1e-5,
-        # top_p=0.95,
-        repetition_penalty=1.15,
-        generation_config=generation_config,
+    # Print the answer as it is generated
+    local_llm = CachedHuggingFaceLLM.from_model(
+        model,
+        tokenizer,
+        generation_config,
+        repetition_penalty=repetition_penalty,
+        callbacks=[StreamingStdOutCallbackHandler()],
     )
-    
-    local_llm = HuggingFacePipeline(pipeline=pipe)
+
+    if compile_mode == "static":
+        # The warmup uses the greedy generation config from_model has set up, and runs on the thread that
+        # generates so the captured CUDA graphs can be replayed there
+        local_llm.worker.run(compile_with_static_cache, model, tokenizer, generation_config, LOGGING)
+    elif quantize_kv_cache:
+        enable_quantized_kv_cache(model, generation_config, LOGGING)
     logging.info("Local LLM Loaded")
     return local_llm
 
 
-def retrieval_qa_pipline(device_type, use_history, promptTemplate_type="llama"):
+def retrieval_qa_pipline(
+    device_type,
+    use_history,
+    promptTemplate_type="llama",
+    kernel=GPTQ_KERNEL,
+    compile_mode="none",
+    vectorstore="chroma",
+    embedding_model=EMBEDDING_MODEL_NAME,
+    embed_device=None,
+    embed_fp32=False,
+    cache_prefix=True,
+    quantize_kv_cache=False,
+    repetition_penalty=1.0,
+    engine="hf",
+):
     """
     Initializes and returns a retrieval-based Question Answering (QA) pipeline.
     This function sets up a QA system that retrieves relevant information using embeddings
@@ -95,8 +156,22 @@ def retrieval_qa_pipline(device_type, use_history, promptTemplate_type="llama"):
     Parameters:
     - device_type (str): Specifies the type of device where the model will run, e.g., 'cpu', 'cuda', etc.
     - use_history (bool): Flag to determine whether to use chat history or not.
+    - kernel (str): The matmul kernel used for GPTQ models.
+    - compile_mode (str): How the model is compiled, one of COMPILE_MODES. Any mode but "none" also compiles
+      the query encoder.
+    - quantize_kv_cache (bool): Flag to store the KV cache of the model in int8.
+    - repetition_penalty (float): Penalty for repeated tokens in the answer, 1.0 disables it.
+    - engine (str): The engine that runs full models, one of ENGINES.
+    - vectorstore (str): The vectorstore used for retrieval, one of VECTORSTORES.
+    - embedding_model (str): The embedding model, the same one ingest.py used.
+    - embed_device (str): The device the queries are embedded on. Defaults to the CPU when the LLM runs on
+      CUDA, and to `device_type` otherwise.
+    - embed_fp32 (bool): Embed the queries in fp32 on the CPU instead of in int8. The int8 embeddings are
+      compared with the ingested ones at startup.
+    - cache_prefix (bool): Prefill the KV cache with the start of the prompt before returning. Pass False to
+      call `prefill_prompt_prefix` later, e.g. while waiting for the first question.
     Returns:
-    - RetrievalQA: An initialized retrieval-based QA system.
+    - PrecompiledRetrievalQA: An initialized retrieval-based QA system.
     Notes:
     - The function uses embeddings from the HuggingFace library, either instruction-based or regular.
     - The Chroma class is used to load a vector store containing pre-computed embeddings.
@@ -106,25 +181,49 @@ def retrieval_qa_pipline(device_type, use_history, promptTemplate_type="llama"):
     - The QA system retrieves relevant documents using the retriever and then answers questions based on those documents.
     """
 
-    embeddings = HuggingFaceInstructEmbeddings(model_name=EMBEDDING_MODEL_NAME, model_kwargs={"device": device_type})
-    # uncomment the following line if you used HuggingFaceEmbeddings in the ingest.py
-    # embeddings = HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL_NAME)
+    if embed_device is None:
+        # Keep the GPU to the LLM, a quantized encoder embeds a single query quickly enough on the CPU
+        embed_device = "cpu" if device_type == "cuda" else device_type
+    logging.info(f"Embedding queries on: {embed_device}")
+    embeddings = load_query_embeddings(
+        embed_device, embedding_model, compile_encoder=compile_mode != "none", quantize=not embed_fp32
+    )
+    embeddings = CachedQueryEmbeddings(embeddings)
 
     # load the vectorstore
     db = Chroma(
         persist_directory=PERSIST_DIRECTORY,
         embedding_function=embeddings,
     )
-    retriever = db.as_retriever()
+    if embed_device == "cpu" and not embed_fp32:
+        # The documents were embedded without int8 quantization unless ingest.py ran on the CPU as well
+        check_embedding_parity(db._collection, embeddings.embeddings)
+    if vectorstore != "chroma":
+        load_vectorstore = load_faiss_vectorstore if vectorstore == "faiss" else load_mmap_vectorstore
+        index_db = load_vectorstore(db, embeddings)
+        if index_db is None:
+            logging.info("The Chroma collection is empty, using Chroma for retrieval")
+        else:
+            db = index_db
+    retriever = db.as_retriever(search_kwargs={"k": 4})
 
     # get the prompt template and memory if set by the user.
     prompt, memory = get_prompt_template(promptTemplate_type=promptTemplate_type, history=use_history)
 
     # load the llm pipeline
-    llm = load_model(device_type, model_id=MODEL_ID, model_basename=MODEL_BASENAME, LOGGING=logging)
-
+    llm = load_model(
+        device_type,
+        model_id=MODEL_ID,
+        model_basename=MODEL_BASENAME,
+        LOGGING=logging,
+        kernel=kernel,
+        compile_mode=compile_mode,
+        quantize_kv_cache=quantize_kv_cache,
+        repetition_penalty=repetition_penalty,
+        engine=engine,
+    )
     if use_history:
-        qa = RetrievalQA.from_chain_type(
+        qa = PrecompiledRetrievalQA.from_chain_type(
             llm=llm,
             chain_type="stuff",  # try other chains types as well. refine, map_reduce, map_rerank
             retriever=retriever,
@@ -133,7 +232,7 @@ def retrieval_qa_pipline(device_type, use_history, promptTemplate_type="llama"):
             chain_type_kwargs={"prompt": prompt, "memory": memory},
         )
     else:
-        qa = RetrievalQA.from_chain_type(
+        qa = PrecompiledRetrievalQA.from_chain_type(
             llm=llm,
             chain_type="stuff",  # try other chains types as well. refine, map_reduce, map_rerank
             retriever=retriever,
@@ -144,37 +243,84 @@ def retrieval_qa_pipline(device_type, use_history, promptTemplate_type="llama"):
             },
         )
 
+    if cache_prefix:
+        prefill_prompt_prefix(qa)
+
     return qa
 
 
+def prefill_prompt_prefix(qa):
+    """
+    Prefill the KV cache with the part of the prompt that is the same for every query.
+    Does nothing for LLMs that cannot reuse a cached prefix.
+    """
+    llm = qa.combine_documents_chain.llm_chain.llm
+    # A static or quantized KV cache cannot start from a cached prefix
+    if isinstance(llm, CachedHuggingFaceLLM) and llm.generation_config.cache_implementation is None:
+        # Everything before the retrieved documents is the same for every query
+        llm.cache_prefix(qa.combine_documents_chain.llm_chain.prompt.template.split("{context}")[0])
+
+
+def warm_up(qa):
+    """
+    Answer a dummy question once without printing anything, so the first real question does not pay for
+    CUDA and cuBLAS initialization, kernel autotuning and compilation.
+    The query is embedded and retrieved like a real one, and the LLM generates a token or two from the full
+    prompt. Errors are logged and otherwise ignored, the first question then just takes longer.
+    """
+    try:
+        retriever = qa.retriever
+        docs = retriever.get_relevant_documents("warmup")
+        combine_chain = qa.combine_documents_chain
+        llm_chain = combine_chain.llm_chain
+        inputs = combine_chain._get_inputs(docs, question="warmup", history="")
+        prompt = llm_chain.prompt.format(**inputs)
+        llm = llm_chain.llm
+        if isinstance(llm, LlamaCpp):
+            # The llama.cpp model itself, its LangChain wrapper would stream to the callbacks
+            llm.client(prompt, max_tokens=1)
+        elif isinstance(llm, (CachedHuggingFaceLLM, TensorRTLLM)):
+            llm.warm_up(prompt)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+            torch.cuda.empty_cache()
+    except Exception as e:
+        logging.info(f"Warmup failed: {e}")
+
+
+def prepare_first_query(qa):
+    prefill_prompt_prefix(qa)
+    warm_up(qa)
+
+
+@contextlib.contextmanager
+def prompt_output():
+    """
+    Print everything written while a prompt is shown above the prompt, so the logs of the background warmup
+    do not break the line being typed. The log handlers keep the stream they were created with, so they are
+    pointed at the patched stderr as well.
+    """
+    with patch_stdout():
+        handlers = [
+            handler
+            for handler in logging.getLogger().handlers
+            if isinstance(handler, logging.StreamHandler) and not isinstance(handler, logging.FileHandler)
+        ]
+        streams = [handler.setStream(sys.stderr) for handler in handlers]
+        try:
+            yield
+        finally:
+            for handler, stream in zip(handlers, streams):
+                if stream is not None:
+                    handler.setStream(stream)
+
+
 # chose device typ to run on as well as to show source documents.
 @click.command()
 @click.option(
     "--device_type",
     default="cuda" if torch.cuda.is_available() else "cpu",
-    type=click.Choice(
-        [
-            "cpu",
-            "cuda",
-            "ipu",
-            "xpu",
-            "mkldnn",
-            "opengl",
-            "opencl",
-            "ideep",
-            "hip",
-            "ve",
-            "fpga",
-            "ort",
-            "xla",
-            "lazy",
-            "vulkan",
-            "mps",
-            "meta",
-            "hpu",
-            "mtia",
-        ],
-    ),
+    type=click.Choice(DEVICE_TYPES),
     help="Device to run on. (Default is cuda)",
 )
 @click.option(
@@ -189,7 +335,85 @@ def retrieval_qa_pipline(device_type, use_history, promptTemplate_type="llama"):
     is_flag=True,
     help="Use history (Default is False)",
 )
-def main(device_type, show_sources, use_history):
+@click.option(
+    "--kernel",
+    default=GPTQ_KERNEL,
+    type=click.Choice(GPTQ_KERNELS),
+    help=f"Quantized matmul kernel for GPTQ models. (Default is {GPTQ_KERNEL})",
+)
+@click.option(
+    "--compile",
+    "compile_mode",
+    default="none",
+    type=click.Choice(COMPILE_MODES),
+    help="Compile the model with torch.compile for any prompt length (dynamic) or with a static KV cache "
+    "(static), slower startup but faster generation (Default is none)",
+)
+@click.option(
+    "--quantize_kv_cache",
+    is_flag=True,
+    help="Store the KV cache in int8, less memory for long contexts but no prefix caching (Default is False)",
+)
+@click.option(
+    "--rep_penalty",
+    "repetition_penalty",
+    default=1.0,
+    type=float,
+    help="Repetition penalty for HuggingFace and GPTQ models, e.g. 1.15 if answers repeat themselves (Default is 1.0)",
+)
+@click.option(
+    "--engine",
+    default="hf",
+    type=click.Choice(ENGINES),
+    help="Engine for full models, trtllm needs a TensorRT-LLM engine, see README (Default is hf)",
+)
+@click.option(
+    "--vectorstore",
+    default="chroma",
+    type=click.Choice(VECTORSTORES),
+    help="Vectorstore used to retrieve the documents. (Default is chroma)",
+)
+@click.option(
+    "--embedding_model",
+    default=EMBEDDING_MODEL_NAME,
+    help=f"Embedding model, the one ingest.py used. (Default is {EMBEDDING_MODEL_NAME})",
+)
+@click.option(
+    "--server",
+    is_flag=True,
+    help="Answer batched queries over HTTP instead of the interactive loop, see query_service.py (Default is False)",
+)
+@click.option("--host", default="127.0.0.1", help="Host to serve on with --server. (Default is 127.0.0.1)")
+@click.option("--port", default=5112, type=int, help="Port to serve on with --server. (Default is 5112)")
+@click.option(
+    "--embed_device",
+    default=None,
+    type=click.Choice(DEVICE_TYPES),
+    help="Device to embed the queries on. (Default is cpu when running on cuda, otherwise device_type)",
+)
+@click.option(
+    "--embed_fp32",
+    is_flag=True,
+    help="Embed the queries in fp32 instead of int8 on the CPU, slower but closer to the ingested embeddings "
+    "(Default is False)",
+)
+def main(
+    device_type,
+    show_sources,
+    use_history,
+    kernel,
+    compile_mode,
+    quantize_kv_cache,
+    repetition_penalty,
+    engine,
+    vectorstore,
+    embedding_model,
+    server,
+    host,
+    port,
+    embed_device,
+    embed_fp32,
+):
     """
     Implements the main information retrieval task for a localGPT.
     This function sets up the QA system by loading the necessary embeddings, vectorstore, and LLM model.
@@ -199,10 +423,25 @@ def main(device_type, show_sources, use_history):
     - device_type (str): Specifies the type of device where the model will run, e.g., 'cpu', 'mps', 'cuda', etc.
     - show_sources (bool): Flag to determine whether to display the source documents used for answering.
     - use_history (bool): Flag to determine whether to use chat history or not.
+    - kernel (str): The matmul kernel used for GPTQ models.
+    - compile_mode (str): How the model is compiled with torch.compile, one of COMPILE_MODES.
+    - quantize_kv_cache (bool): Flag to store the KV cache of the model in int8.
+    - repetition_penalty (float): Penalty for repeated tokens in the answer, 1.0 disables it.
+    - engine (str): The engine that runs full models.
+    - vectorstore (str): The vectorstore used for retrieval.
+    - embedding_model (str): The embedding model, the same one ingest.py used.
+    - server (bool): Flag to serve queries over HTTP instead of running the interactive loop.
+    - host (str): The host the server listens on.
+    - port (int): The port the server listens on.
+    - embed_device (str): The device the queries are embedded on.
+    - embed_fp32 (bool): Flag to embed the queries in fp32 instead of int8 on the CPU.
     Notes:
     - Logging information includes the device type, whether source documents are displayed, and the use of history.
     - If the models directory does not exist, it creates a new one to store models.
-    - The user can exit the interactive loop by entering "exit".
+    - The user can exit the interactive loop by entering "exit" or pressing Ctrl-D.
+    - The start of the prompt is prefilled and the model is warmed up in the background while the first
+      question is typed.
+    - The answer is printed while it is generated, Ctrl-C stops the current answer.
     - The source documents are displayed if the show_sources flag is set to True.
     """
 
@@ -214,22 +453,73 @@ def main(device_type, show_sources, use_history):
     if not os.path.exists(MODELS_PATH):
         os.mkdir(MODELS_PATH)
 
-    qa = retrieval_qa_pipline(device_type, use_history, promptTemplate_type="")
+    if server and use_history:
+        # Chat history is shared by the whole chain, so the server answers every query without it
+        logging.info("Chat history is not used in server mode")
+        use_history = False
+
+    if compile_mode == "static" and quantize_kv_cache:
+        # The compiled graphs are captured for the static cache
+        logging.info("--quantize_kv_cache is not used together with --compile static")
+        quantize_kv_cache = False
 
-    # Interactive questions and answers
+    qa = retrieval_qa_pipline(
+        device_type,
+        use_history,
+        promptTemplate_type="",
+        kernel=kernel,
+        compile_mode=compile_mode,
+        vectorstore=vectorstore,
+        embedding_model=embedding_model,
+        embed_device=embed_device,
+        embed_fp32=embed_fp32,
+        quantize_kv_cache=quantize_kv_cache,
+        repetition_penalty=repetition_penalty,
+        engine=engine,
+        # The interactive loop prefills it while waiting for the first question
+        cache_prefix=server,
+    )
+
+    if server:
+        # Imported here because query_service imports this module
+        from query_service import serve
+
+        warm_up(qa)
+        serve(qa, host=host, port=port)
+        return
+
+    # Runs while the first question is typed
+    warmup = threading.Thread(target=prepare_first_query, args=(qa,))
+    warmup.start()
+
+    # Interactive questions and answers, with line editing and the previous questions on the up arrow.
+    # The loop stays synchronous so Ctrl-C interrupts the answer in the main thread.
+    session = PromptSession()
     while True:
-        query = input("\nEnter a query: ")
+        try:
+            with prompt_output():
+                query = session.prompt("\nEnter a query: ")
+        except KeyboardInterrupt:
+            continue
+        except EOFError:
+            break
         if query == "exit":
             break
-        # Get the answer from the chain
-        res = qa(query)
-        answer, docs = res["result"], res["source_documents"]
-
-        # Print the result
+        if warmup is not None:
+            # A first question can come in before the prefix is prefilled and the model warmed up
+            warmup.join()
+            warmup = None
         print("\n\n> Question:")
         print(query)
         print("\n> Answer:")
-        print(answer)
+        # Get the answer from the chain, the LLM prints it as it is generated
+        try:
+            res = qa(query)
+        except KeyboardInterrupt:
+            print("\n> Generation cancelled")
+            continue
+        print()
+        docs = res["source_documents"]
 
         if show_sources:  # this is a flag that you can set to disable showing answers.
             # # Print the relevant sources used for the answer
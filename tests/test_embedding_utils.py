@@ -0,0 +1,49 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+embedding_utils = pytest.importorskip("embedding_utils")
+
+
+class FakeCollection:
+    def __init__(self, vectors):
+        self.vectors = vectors
+
+    def get(self, limit=None, include=()):
+        vectors = self.vectors[:limit]
+        return {
+            "ids": [f"id{i}" for i in range(len(vectors))],
+            "embeddings": vectors.tolist(),
+            "documents": [str(i) for i in range(len(vectors))],
+        }
+
+
+class NoisyEmbeddings:
+    """Embeds document i as the stored vector i plus noise, like a quantized copy of the ingest model."""
+
+    def __init__(self, vectors, noise):
+        self.vectors = vectors
+        self.noise = noise
+
+    def embed_documents(self, texts):
+        rng = np.random.default_rng(0)
+        return [self.vectors[int(text)] + rng.normal(scale=self.noise, size=self.vectors.shape[1]) for text in texts]
+
+
+@pytest.fixture
+def vectors():
+    return np.random.default_rng(1).normal(size=(16, 32)).astype(np.float32)
+
+
+def test_close_embeddings_pass(vectors):
+    similarity = embedding_utils.check_embedding_parity(FakeCollection(vectors), NoisyEmbeddings(vectors, 0.01))
+    assert similarity > embedding_utils.EMBEDDING_MIN_SIMILARITY
+
+
+def test_distant_embeddings_are_reported(vectors, caplog):
+    similarity = embedding_utils.check_embedding_parity(FakeCollection(vectors), NoisyEmbeddings(vectors, 1.0))
+    assert similarity < embedding_utils.EMBEDDING_MIN_SIMILARITY
+    assert "--embed_fp32" in caplog.text
+
+
+def test_empty_collection_is_not_checked():
+    assert embedding_utils.check_embedding_parity(FakeCollection(np.empty((0, 4))), None) is None
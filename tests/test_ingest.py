@@ -0,0 +1,89 @@
+import os
+
+import pytest
+
+np = pytest.importorskip("numpy")
+ingest = pytest.importorskip("ingest")
+
+from langchain.docstore.document import Document  # noqa: E402
+
+SOURCE = os.path.join("SOURCE_DOCUMENTS", "")
+TORCH = {"model": "hkunlp/instructor-large", "backend": "torch"}
+MINILM = {"model": "sentence-transformers/all-MiniLM-L6-v2", "backend": "torch"}
+
+
+def path(name):
+    return os.path.join("SOURCE_DOCUMENTS", name)
+
+
+class RecordingCollection:
+    def __init__(self):
+        self.deleted = []
+        self.added = []
+
+    def delete(self, where):
+        self.deleted.append(where["source"])
+
+    def add(self, ids, embeddings, documents, metadatas):
+        self.added.extend(metadata["source"] for metadata in metadatas)
+
+
+def manifest(files, embeddings=TORCH):
+    return {"embeddings": embeddings, "files": files}
+
+
+def test_unchanged_files_are_skipped():
+    files = {path("a.txt"): "1", path("b.txt"): "2"}
+    changed, removed, rebuild = ingest.diff_manifest(manifest(files), dict(files), SOURCE, TORCH)
+    assert (changed, removed, rebuild) == ([], [], False)
+
+
+def test_modified_file_is_changed_and_its_chunks_replaced():
+    old = manifest({path("a.txt"): "1", path("b.txt"): "2"})
+    file_hashes = {path("a.txt"): "1", path("b.txt"): "3"}
+    changed, removed, rebuild = ingest.diff_manifest(old, file_hashes, SOURCE, TORCH)
+    assert (changed, removed, rebuild) == ([path("b.txt")], [], False)
+
+    collection = RecordingCollection()
+    texts = [Document(page_content="new", metadata={"source": path("b.txt")})]
+    ingest.replace_chunks(collection, changed + removed, texts, np.zeros((1, 4)))
+    assert collection.deleted == [path("b.txt")]
+    assert collection.added == [path("b.txt")]
+    new = ingest.update_manifest(old, file_hashes, changed, removed, rebuild, TORCH)
+    assert new == manifest(file_hashes)
+
+
+def test_removed_file_is_purged():
+    old = manifest({path("a.txt"): "1", path("b.txt"): "2", "other/c.txt": "4"})
+    file_hashes = {path("a.txt"): "1"}
+    changed, removed, rebuild = ingest.diff_manifest(old, file_hashes, SOURCE, TORCH)
+    # Files ingested from another directory are kept
+    assert (changed, removed, rebuild) == ([], [path("b.txt")], False)
+
+    collection = RecordingCollection()
+    ingest.replace_chunks(collection, changed + removed, [], None)
+    assert collection.deleted == [path("b.txt")]
+    assert collection.added == []
+    new = ingest.update_manifest(old, file_hashes, changed, removed, rebuild, TORCH)
+    assert new == manifest({path("a.txt"): "1", "other/c.txt": "4"})
+
+
+def test_other_embedding_model_rebuilds_everything():
+    old = manifest({path("a.txt"): "1", "other/c.txt": "4"})
+    file_hashes = {path("a.txt"): "1", path("b.txt"): "2"}
+    changed, removed, rebuild = ingest.diff_manifest(old, file_hashes, SOURCE, MINILM)
+    assert rebuild
+    assert sorted(changed) == [path("a.txt"), path("b.txt")]
+    assert removed == []
+    new = ingest.update_manifest(old, file_hashes, changed, removed, rebuild, MINILM)
+    assert new == manifest(file_hashes, MINILM)
+
+
+def test_manifest_without_embedding_model_rebuilds_everything(tmp_path, monkeypatch):
+    manifest_file = tmp_path / "manifest.json"
+    manifest_file.write_text('{"SOURCE_DOCUMENTS/a.txt": "1"}')
+    monkeypatch.setattr(ingest, "INGEST_MANIFEST", str(manifest_file))
+    old = ingest.load_manifest()
+    assert old == {"embeddings": None, "files": {"SOURCE_DOCUMENTS/a.txt": "1"}}
+    changed, _, rebuild = ingest.diff_manifest(old, {path("a.txt"): "1"}, SOURCE, TORCH)
+    assert rebuild and changed == [path("a.txt")]
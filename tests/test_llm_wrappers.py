@@ -0,0 +1,128 @@
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+torch = pytest.importorskip("torch")
+llm_wrappers = pytest.importorskip("llm_wrappers")
+
+from transformers import DynamicCache  # noqa: E402
+
+CachedHuggingFaceLLM = llm_wrappers.CachedHuggingFaceLLM
+
+
+def ids(*tokens):
+    return torch.tensor(tokens)
+
+
+def filled_cache(length, layers=2):
+    # Position i of every layer holds the value i, so a cropped cache shows which positions it kept
+    cache = DynamicCache()
+    positions = torch.arange(length, dtype=torch.float32).view(1, 1, length, 1)
+    for layer in range(layers):
+        cache.update(positions.clone(), positions.clone(), layer)
+    return cache
+
+
+class CharTokenizer:
+    # One token per character
+    def __call__(self, text, return_tensors=None):
+        return SimpleNamespace(input_ids=torch.tensor([[ord(c) for c in text]]))
+
+    def decode(self, token_ids, skip_special_tokens=False):
+        return "".join(chr(int(i)) for i in token_ids)
+
+
+class RecordingModel:
+    """Answers "ok", records the arguments of every generate call and extends the cache it is given."""
+
+    device = torch.device("cpu")
+
+    def __init__(self):
+        self.calls = []
+
+    def generate(self, input_ids, past_key_values=None, streamer=None, **kwargs):
+        cached = past_key_values.get_seq_length() if past_key_values is not None else None
+        self.calls.append({"input_ids": input_ids, "cached": cached})
+        output_ids = torch.cat([input_ids, torch.tensor([[ord("o"), ord("k")]])], dim=1)
+        if past_key_values is not None:
+            new = output_ids.shape[1] - cached
+            for layer in range(len(past_key_values)):
+                past_key_values.update(torch.zeros(1, 1, new, 1), torch.zeros(1, 1, new, 1), layer)
+        streamer.put(input_ids)
+        streamer.put(output_ids[0, input_ids.shape[1] :])
+        streamer.end()
+        return output_ids
+
+
+def make_llm(prefix=None):
+    llm = CachedHuggingFaceLLM(
+        model=RecordingModel(),
+        tokenizer=CharTokenizer(),
+        generation_config=None,
+        cancel=threading.Event(),
+        worker=llm_wrappers.ModelWorker(),
+    )
+    if prefix is not None:
+        llm.prefix_ids = llm.tokenizer(prefix).input_ids[0]
+        llm.prefix_cache = filled_cache(len(prefix))
+    return llm
+
+
+def test_common_length_without_common_prefix():
+    assert CachedHuggingFaceLLM._common_length(ids(), ids(1, 2, 3)) == 0
+    assert CachedHuggingFaceLLM._common_length(ids(9, 2, 3), ids(1, 2, 3)) == 0
+
+
+def test_common_length_full_match_leaves_one_token():
+    assert CachedHuggingFaceLLM._common_length(ids(1, 2), ids(1, 2, 3)) == 2
+    # The whole prompt is cached, generate still needs its last token
+    assert CachedHuggingFaceLLM._common_length(ids(1, 2, 3), ids(1, 2, 3)) == 2
+    assert CachedHuggingFaceLLM._common_length(ids(1, 2, 3, 4), ids(1, 2, 3)) == 2
+    assert CachedHuggingFaceLLM._common_length(ids(1), ids(1)) == 0
+
+
+def test_common_length_divergence_mid_prompt():
+    assert CachedHuggingFaceLLM._common_length(ids(1, 2, 3, 4), ids(1, 2, 7, 4, 5)) == 2
+    assert CachedHuggingFaceLLM._common_length(ids(1, 2, 3, 4), ids(1, 2, 3, 9, 5)) == 3
+
+
+def test_crop_dynamic_cache():
+    cache = llm_wrappers.crop_cache(filled_cache(5), 3)
+    assert cache.get_seq_length() == 3
+    for layer in range(len(cache)):
+        key, value = cache[layer]
+        assert key.flatten().tolist() == [0, 1, 2]
+        assert value.flatten().tolist() == [0, 1, 2]
+
+
+def test_crop_legacy_cache():
+    positions = torch.arange(5, dtype=torch.float32).view(1, 1, 5, 1)
+    cache = llm_wrappers.crop_cache(((positions, positions),), 2)
+    assert [tensor.flatten().tolist() for tensor in cache[0]] == [[0, 1], [0, 1]]
+
+
+def test_prompt_with_the_cached_prefix_reuses_it():
+    llm = make_llm(prefix="system:")
+    assert llm._call("system: question") == "ok"
+    call = llm.model.calls[0]
+    assert call["cached"] == len("system:")
+    assert CharTokenizer().decode(call["input_ids"][0]) == "system: question"
+    # The prefix cache is copied, not extended in place
+    assert llm.prefix_cache.get_seq_length() == len("system:")
+    # The prompt is kept for the next call, without the answer
+    assert llm.last_cache.get_seq_length() == len("system: question")
+
+
+def test_prompt_without_the_cached_prefix_is_not_given_a_cache():
+    llm = make_llm(prefix="system:")
+    assert llm._call("other: question") == "ok"
+    assert llm.model.calls[0]["cached"] is None
+    assert llm.last_cache is None
+
+
+def test_prompt_diverging_from_the_last_prompt_reuses_the_common_part():
+    llm = make_llm(prefix="sys:")
+    llm._call("sys: first question")
+    llm._call("sys: first answer")
+    assert llm.model.calls[1]["cached"] == len("sys: first ")
@@ -0,0 +1,62 @@
+import asyncio
+from types import SimpleNamespace
+from typing import Any, List, Optional
+
+import pytest
+
+query_service = pytest.importorskip("query_service")
+
+from langchain.chains.question_answering import load_qa_chain  # noqa: E402
+from langchain.embeddings import FakeEmbeddings  # noqa: E402
+from langchain.llms.base import LLM  # noqa: E402
+from langchain.schema import Document, Generation, LLMResult  # noqa: E402
+
+
+class RecordingLLM(LLM):
+    """Answers every prompt with its number and records the prompts of each generate call."""
+
+    calls: List[List[str]] = []
+
+    @property
+    def _llm_type(self) -> str:
+        return "recording"
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None, run_manager: Any = None, **kwargs: Any) -> str:
+        return self._generate([prompt]).generations[0][0].text
+
+    def _generate(self, prompts: List[str], stop=None, run_manager=None, **kwargs: Any) -> LLMResult:
+        self.calls.append(prompts)
+        return LLMResult(generations=[[Generation(text=f"answer {i}")] for i in range(len(prompts))])
+
+
+class FakeVectorstore:
+    embeddings = FakeEmbeddings(size=8)
+
+    def similarity_search_by_vector(self, vector, k=4):
+        return [Document(page_content="context", metadata={"source": "SOURCE_DOCUMENTS/doc.txt"})] * k
+
+
+def test_batch_is_answered_in_one_generate_call():
+    llm = RecordingLLM(calls=[])
+    qa = SimpleNamespace(
+        retriever=SimpleNamespace(vectorstore=FakeVectorstore(), search_kwargs={"k": 2}),
+        combine_documents_chain=load_qa_chain(llm, chain_type="stuff"),
+    )
+    queries = [f"question {i}" for i in range(5)]
+
+    async def answer_concurrently():
+        batcher = query_service.QueryBatcher(qa, max_batch_size=len(queries), timeout=1.0)
+        runner = asyncio.create_task(batcher.run())
+        try:
+            return await asyncio.gather(*(batcher.submit(query) for query in queries))
+        finally:
+            runner.cancel()
+
+    results = asyncio.run(answer_concurrently())
+
+    assert len(llm.calls) == 1
+    assert len(llm.calls[0]) == len(queries)
+    assert all(query in prompt for query, prompt in zip(queries, llm.calls[0]))
+    assert [result["Prompt"] for result in results] == queries
+    assert [result["Answer"] for result in results] == [f"answer {i}" for i in range(len(queries))]
+    assert results[0]["Sources"] == [("doc.txt", "context")] * 2
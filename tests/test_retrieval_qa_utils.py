@@ -0,0 +1,75 @@
+from typing import Any, List
+
+import pytest
+
+pytest.importorskip("langchain")
+
+from langchain.chains import RetrievalQA  # noqa: E402
+from langchain.llms.base import LLM  # noqa: E402
+from langchain.prompts import PromptTemplate  # noqa: E402
+from langchain.schema import BaseRetriever, Document  # noqa: E402
+
+from prompt_template_utils import get_prompt_template  # noqa: E402
+from retrieval_qa_utils import PrecompiledRetrievalQA, compile_template  # noqa: E402
+
+VALUES = {
+    "context": "The {first} amendment }{ protects speech.\n\nSecond document {{ with braces }}.",
+    "question": "What does {it} protect?",
+    "history": "Human: hi {there}\nAI: hello",
+}
+
+
+@pytest.mark.parametrize("promptTemplate_type", ["llama", ""])
+@pytest.mark.parametrize("history", [True, False])
+def test_compiled_system_templates_match_prompt_template(promptTemplate_type, history):
+    prompt, _ = get_prompt_template(promptTemplate_type=promptTemplate_type, history=history)
+    values = {key: VALUES[key] for key in prompt.input_variables}
+    assert compile_template(prompt.template)(values) == prompt.format(**values)
+
+
+def test_compiled_template_with_literal_braces():
+    template = "{{literal}} {{{question}}} and }} {context}{{"
+    values = {"question": VALUES["question"], "context": VALUES["context"]}
+    prompt = PromptTemplate(input_variables=["question", "context"], template=template)
+    assert compile_template(template)(values) == prompt.format(**values)
+
+
+def test_templates_with_format_specs_are_not_compiled():
+    assert compile_template("{question!r}") is None
+    assert compile_template("{question:>10}") is None
+
+
+class RecordingLLM(LLM):
+    prompts: List[str] = []
+
+    @property
+    def _llm_type(self) -> str:
+        return "recording"
+
+    def _call(self, prompt: str, stop=None, run_manager=None, **kwargs: Any) -> str:
+        self.prompts.append(prompt)
+        return "answer"
+
+
+class StaticRetriever(BaseRetriever):
+    def _get_relevant_documents(self, query, *, run_manager=None):
+        return [
+            Document(page_content="The {first} amendment }{ protects speech.", metadata={"source": "a.txt"}),
+            Document(page_content="Second document {{ with braces }}.", metadata={"source": "b.txt"}),
+        ]
+
+
+@pytest.mark.parametrize("history", [True, False])
+def test_precompiled_chain_sends_the_same_prompt(history):
+    prompts = []
+    for chain_class in (PrecompiledRetrievalQA, RetrievalQA):
+        prompt, memory = get_prompt_template(promptTemplate_type="llama", history=history)
+        chain_type_kwargs = {"prompt": prompt, "memory": memory} if history else {"prompt": prompt}
+        llm = RecordingLLM(prompts=[])
+        qa = chain_class.from_chain_type(
+            llm=llm, chain_type="stuff", retriever=StaticRetriever(), chain_type_kwargs=chain_type_kwargs
+        )
+        qa("What does {it} protect?")
+        qa("And the second one?")
+        prompts.append(llm.prompts)
+    assert prompts[0] == prompts[1]
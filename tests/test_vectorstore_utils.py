@@ -0,0 +1,77 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+vectorstore_utils = pytest.importorskip("vectorstore_utils")
+
+
+class FakeCollection:
+    """The parts of a Chroma collection the mmap index reads, returning rows out of the requested order."""
+
+    def __init__(self, vectors):
+        self.ids = [f"id{i}" for i in range(len(vectors))]
+        self.vectors = vectors
+
+    def get(self, ids=None, include=()):
+        if ids is None:
+            return {"ids": self.ids, "embeddings": self.vectors.tolist()}
+        found = sorted(ids, reverse=True)
+        return {
+            "ids": found,
+            "documents": [f"text of {id}" for id in found],
+            "metadatas": [{"source": id} for id in found],
+        }
+
+
+class FakeChroma:
+    def __init__(self, vectors):
+        self._collection = FakeCollection(vectors)
+
+
+@pytest.fixture
+def index(tmp_path, monkeypatch):
+    # is_up_to_date compares the index with the Chroma database file
+    (tmp_path / "chroma.sqlite3").touch()
+    monkeypatch.setattr(vectorstore_utils, "PERSIST_DIRECTORY", str(tmp_path))
+    monkeypatch.setattr(vectorstore_utils, "MMAP_INDEX_DIRECTORY", str(tmp_path / "mmap"))
+    # Not normalized, the index normalizes the rows
+    vectors = np.random.default_rng(0).normal(size=(20, 8)).astype(np.float32) * 3
+    return vectors, vectorstore_utils.load_mmap_vectorstore(FakeChroma(vectors), embeddings=None)
+
+
+def brute_force(vectors, query):
+    normalized = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    scores = normalized @ (query / np.linalg.norm(query))
+    order = np.argsort(-scores)
+    return [f"id{i}" for i in order], scores[order]
+
+
+def test_index_is_memory_mapped(index):
+    _, store = index
+    assert isinstance(store.vectors, np.memmap)
+
+
+@pytest.mark.parametrize("k", [1, 4, 20])
+def test_results_follow_brute_force_cosine_order(index, k):
+    vectors, store = index
+    query = np.random.default_rng(1).normal(size=8)
+    expected_ids, expected_scores = brute_force(vectors, query)
+    results = store.similarity_search_with_score_by_vector(query.tolist(), k=k)
+    assert [doc.metadata["source"] for doc, _ in results] == expected_ids[:k]
+    assert [doc.page_content for doc, _ in results] == [f"text of {id}" for id in expected_ids[:k]]
+    np.testing.assert_allclose([score for _, score in results], expected_scores[:k], rtol=1e-5)
+
+
+def test_k_larger_than_the_collection_returns_everything(index):
+    vectors, store = index
+    query = vectors[3]
+    expected_ids, _ = brute_force(vectors, query)
+    results = store.similarity_search_by_vector(query.tolist(), k=50)
+    assert [doc.metadata["source"] for doc in results] == expected_ids
+    assert results[0].metadata["source"] == "id3"
+
+
+def test_empty_collection_has_no_index(tmp_path, monkeypatch):
+    (tmp_path / "chroma.sqlite3").touch()
+    monkeypatch.setattr(vectorstore_utils, "PERSIST_DIRECTORY", str(tmp_path))
+    monkeypatch.setattr(vectorstore_utils, "MMAP_INDEX_DIRECTORY", str(tmp_path / "mmap"))
+    assert vectorstore_utils.load_mmap_vectorstore(FakeChroma(np.empty((0, 8), np.float32)), None) is None
@@ -0,0 +1,188 @@
+"""
+This file implements the FAISS and memory-mapped vectorstores that can be used instead of Chroma to answer queries.
+Chroma stays the store that ingest.py writes to; the other indexes are built from the Chroma collection.
+"""
+
+import json
+import logging
+import os
+
+import faiss
+import numpy as np
+from langchain.docstore.document import Document
+from langchain.docstore.in_memory import InMemoryDocstore
+from langchain.vectorstores import FAISS
+from langchain.vectorstores.base import VectorStore
+from langchain.vectorstores.utils import DistanceStrategy
+
+from constants import FAISS_HNSW_THRESHOLD, FAISS_INDEX_DIRECTORY, MMAP_INDEX_DIRECTORY, PERSIST_DIRECTORY
+
+
+class EmbeddingsFAISS(FAISS):
+    """
+    FAISS vectorstore that also exposes its Embeddings object, like Chroma does.
+    langchain's FAISS only keeps the `embed_query` function, but the query service embeds whole batches of
+    queries through `vectorstore.embeddings`.
+    """
+
+    @property
+    def embeddings(self):
+        # embedding_function is the bound embed_query method of the Embeddings object
+        return getattr(self.embedding_function, "__self__", None)
+
+
+def is_up_to_date(index_path):
+    # ingest.py only writes to Chroma, so an index written after the last ingest still matches the collection
+    chroma_path = os.path.join(PERSIST_DIRECTORY, "chroma.sqlite3")
+    return os.path.exists(index_path) and os.path.getmtime(index_path) >= os.path.getmtime(chroma_path)
+
+
+def build_faiss_index(vectors):
+    """
+    Build an inner product index over L2-normalized vectors, so the scores are cosine similarities.
+    Exact search is used up to FAISS_HNSW_THRESHOLD vectors, larger collections use an HNSW graph.
+    """
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    faiss.normalize_L2(vectors)
+    dimension = vectors.shape[1]
+    if len(vectors) >= FAISS_HNSW_THRESHOLD:
+        index = faiss.IndexHNSWFlat(dimension, 32, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = 200
+        index.hnsw.efSearch = 64
+    else:
+        index = faiss.IndexFlatIP(dimension)
+    index.add(vectors)
+    return index
+
+
+def load_faiss_vectorstore(db, embeddings):
+    """
+    Load the FAISS copy of a Chroma collection, (re)building it when the collection has changed.
+    Parameters:
+    - db (Chroma): The Chroma vectorstore written by ingest.py.
+    - embeddings (Embeddings): The embedding model used for the queries.
+    Returns:
+    - EmbeddingsFAISS: The FAISS vectorstore, or None if the Chroma collection is empty.
+    Notes:
+    - The index is saved to FAISS_INDEX_DIRECTORY and reused as long as it is newer than the Chroma database.
+    """
+    index_path = os.path.join(FAISS_INDEX_DIRECTORY, "index.faiss")
+    if is_up_to_date(index_path):
+        logging.info(f"Loading the FAISS index from {FAISS_INDEX_DIRECTORY}")
+        return EmbeddingsFAISS.load_local(
+            FAISS_INDEX_DIRECTORY, embeddings, distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT
+        )
+
+    collection = db._collection.get(include=["embeddings", "documents", "metadatas"])
+    if not collection["ids"]:
+        return None
+
+    logging.info(f"Building a FAISS index over {len(collection['ids'])} chunks")
+    index = build_faiss_index(collection["embeddings"])
+    docstore = InMemoryDocstore(
+        {
+            id: Document(page_content=text, metadata=metadata or {})
+            for id, text, metadata in zip(collection["ids"], collection["documents"], collection["metadatas"])
+        }
+    )
+    store = EmbeddingsFAISS(
+        embeddings.embed_query,
+        index,
+        docstore,
+        dict(enumerate(collection["ids"])),
+        distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT,
+    )
+    store.save_local(FAISS_INDEX_DIRECTORY)
+    return store
+
+
+class MmapVectorStore(VectorStore):
+    """
+    Exact cosine similarity search over a memory-mapped matrix of L2-normalized embeddings.
+    Each query is a single matrix-vector product over the whole collection, the rows are paged in by the OS
+    instead of being deserialized from Chroma on every start. Only the texts and metadata of the k results
+    are read from Chroma.
+    Parameters:
+    - db (Chroma): The Chroma vectorstore written by ingest.py, used to look up the documents.
+    - embeddings (Embeddings): The embedding model used for the queries.
+    - vectors (np.ndarray): The L2-normalized float32 embeddings, one row per chunk.
+    - ids (List[str]): The Chroma id of every row.
+    """
+
+    def __init__(self, db, embeddings, vectors, ids):
+        self.db = db
+        self._embeddings = embeddings
+        self.vectors = vectors
+        self.ids = ids
+
+    @property
+    def embeddings(self):
+        return self._embeddings
+
+    def add_texts(self, texts, metadatas=None, **kwargs):
+        raise NotImplementedError("ingest.py adds documents to Chroma, the index is rebuilt from it on the next run")
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, **kwargs):
+        raise NotImplementedError("The index is built from Chroma with load_mmap_vectorstore")
+
+    def similarity_search_with_score_by_vector(self, embedding, k=4, **kwargs):
+        query = np.array(embedding, dtype=np.float32)
+        query /= max(np.linalg.norm(query), 1e-12)
+        scores = self.vectors @ query
+        k = min(k, len(scores))
+        if k == 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+
+        ids = [self.ids[i] for i in top]
+        found = self.db._collection.get(ids=ids, include=["documents", "metadatas"])
+        # Chroma does not return the rows in the order of the ids
+        documents = {
+            id: Document(page_content=text, metadata=metadata or {})
+            for id, text, metadata in zip(found["ids"], found["documents"], found["metadatas"])
+        }
+        return [(documents[id], float(scores[i])) for id, i in zip(ids, top) if id in documents]
+
+    def similarity_search_by_vector(self, embedding, k=4, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score_by_vector(embedding, k)]
+
+    def similarity_search_with_score(self, query, k=4, **kwargs):
+        return self.similarity_search_with_score_by_vector(self._embeddings.embed_query(query), k)
+
+    def similarity_search(self, query, k=4, **kwargs):
+        return self.similarity_search_by_vector(self._embeddings.embed_query(query), k)
+
+
+def load_mmap_vectorstore(db, embeddings):
+    """
+    Memory-map the normalized embeddings of a Chroma collection, (re)writing them when the collection has changed.
+    Parameters:
+    - db (Chroma): The Chroma vectorstore written by ingest.py.
+    - embeddings (Embeddings): The embedding model used for the queries.
+    Returns:
+    - MmapVectorStore: The vectorstore, or None if the Chroma collection is empty.
+    Notes:
+    - The embeddings are saved to MMAP_INDEX_DIRECTORY and reused as long as they are newer than the Chroma database.
+    - The rows are stored as float32, which numpy multiplies with BLAS; float16 would halve the file but not the time.
+    """
+    vectors_path = os.path.join(MMAP_INDEX_DIRECTORY, "embeddings.npy")
+    ids_path = os.path.join(MMAP_INDEX_DIRECTORY, "ids.json")
+    if not (is_up_to_date(vectors_path) and os.path.exists(ids_path)):
+        collection = db._collection.get(include=["embeddings"])
+        if not collection["ids"]:
+            return None
+        logging.info(f"Writing the embeddings of {len(collection['ids'])} chunks to {MMAP_INDEX_DIRECTORY}")
+        vectors = np.asarray(collection["embeddings"], dtype=np.float32)
+        vectors /= np.clip(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12, None)
+        os.makedirs(MMAP_INDEX_DIRECTORY, exist_ok=True)
+        with open(ids_path, "w") as f:
+            json.dump(collection["ids"], f)
+        # Written last, so an interrupted run leaves an index that is older than the ids and is rebuilt
+        np.save(vectors_path, vectors)
+
+    logging.info(f"Memory-mapping the embeddings from {MMAP_INDEX_DIRECTORY}")
+    with open(ids_path) as f:
+        ids = json.load(f)
+    return MmapVectorStore(db, embeddings, np.load(vectors_path, mmap_mode="r"), ids)